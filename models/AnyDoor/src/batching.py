@@ -0,0 +1,108 @@
+"""Cross-request batching for the RunPod handlers.
+
+Jobs that can share one sampler call (same batch key, e.g. resolution, steps and sampler) and
+arrive within BATCH_MAX_WAIT_MS of each other run as a single batch. The GPU work runs on one
+worker thread, so the event loop keeps accepting jobs while a batch is on the GPU. Batches that
+are due while the GPU is busy keep growing until it is free, which costs no extra latency.
+"""
+import asyncio
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", 4))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", 50))
+
+
+def batch_noise(seeds, shape, device="cuda"):
+    """Per-sample x_T so every job in a batch gets the noise its own seed gives at batch size 1."""
+    return torch.cat([torch.randn((1, *shape), generator=torch.Generator(device=device).manual_seed(int(seed)),
+                                  device=device) for seed in seeds])
+
+
+def batch_guidance_scale(scales, device="cuda"):
+    """A float when all jobs agree (keeps the scale == 1 shortcut), else a (b, 1, 1, 1) tensor."""
+    if len(set(scales)) == 1:
+        return float(scales[0])
+    return torch.tensor(scales, dtype=torch.float32, device=device).view(-1, 1, 1, 1)
+
+
+class DynamicBatcher(object):
+    def __init__(self, run_batch, max_batch_size=BATCH_MAX_SIZE, max_wait=BATCH_MAX_WAIT_MS / 1000.):
+        # run_batch(items) -> one result per item, blocking; all items share a batch key
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = dict()
+        self.due = deque()
+        self.running = 0
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def concurrency_modifier(self, current_concurrency):
+        # RunPod: take enough jobs at once to fill a batch
+        return self.max_batch_size
+
+    async def submit(self, key, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self.pending.setdefault(key, [])
+        batch.append((item, future))
+        if len(batch) >= self.max_batch_size:
+            self.dispatch(key, batch)
+        elif len(batch) == 1:
+            loop.call_later(self.max_wait, self.expire, key, batch)
+        return await future
+
+    def expire(self, key, batch):
+        # the timer of a batch that was already dispatched must not touch its successor
+        if self.pending.get(key) is not batch:
+            return
+        if self.running:
+            self.due.append((key, batch))
+        else:
+            self.dispatch(key, batch)
+
+    def dispatch(self, key, batch):
+        del self.pending[key]
+        # jobs RunPod cancelled (timed out) while waiting are not worth a place in the batch
+        batch = [(item, future) for item, future in batch if not future.done()]
+        if not batch:
+            return
+        self.running += 1
+        asyncio.ensure_future(self.run(batch))
+
+    async def run(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            try:
+                results = await loop.run_in_executor(self.executor, self.run_batch, [item for item, _ in batch])
+                outcomes = [(result, None) for result in results]
+            except Exception as e:
+                if len(batch) == 1:
+                    outcomes = [(None, e)]
+                else:
+                    # one bad job should not fail the others, rerun them one by one
+                    outcomes = [await self.run_single(loop, item) for item, _ in batch]
+            for (_, future), (result, error) in zip(batch, outcomes):
+                # cancelled while the batch ran, setting a result would raise and strand the others
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+        finally:
+            self.running -= 1
+            while not self.running and self.due:
+                key, due = self.due.popleft()
+                if self.pending.get(key) is due:
+                    self.dispatch(key, due)
+
+    async def run_single(self, loop, item):
+        try:
+            return (await loop.run_in_executor(self.executor, self.run_batch, [item]))[0], None
+        except Exception as e:
+            return None, e
@@ -334,8 +334,14 @@ class ControlLDM(LatentDiffusion):
         if cond['c_concat'] is None:
             eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=None, only_mid_control=self.only_mid_control)
         else:
-            control = self.control_model(x=x_noisy, hint=torch.cat(cond['c_concat'], 1), timesteps=t, context=cond_txt)
+            hint = torch.cat(cond['c_concat'], 1)
+            # with batched guidance in guess mode only the leading samples carry a hint, the rest
+            # get zero residuals, which is the same as control=None for them
+            n = hint.shape[0]
+            control = self.control_model(x=x_noisy[:n], hint=hint, timesteps=t[:n], context=cond_txt[:n])
             control = [c * scale for c, scale in zip(control, self.control_scales)]
+            if n < x_noisy.shape[0]:
+                control = [torch.cat([c, c.new_zeros((x_noisy.shape[0] - n, *c.shape[1:]))]) for c in control]
             eps = diffusion_model(x=x_noisy, timesteps=t, context=cond_txt, control=control, only_mid_control=self.only_mid_control)
         return eps
 
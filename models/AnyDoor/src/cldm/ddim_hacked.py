@@ -8,11 +8,15 @@ from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, mak
 
 
 class DDIMSampler(object):
-    def __init__(self, model, schedule="linear", **kwargs):
+    def __init__(self, model, schedule="linear", batched_cfg=False, **kwargs):
         super().__init__()
         self.model = model
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
+        # run cond and uncond through a single apply_model call per step
+        self.batched_cfg = batched_cfg
+        # (ddim_num_steps, ddim_discretize, ddim_eta) -> buffers set by make_schedule
+        self.schedule_cache = dict()
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
@@ -21,6 +25,12 @@ class DDIMSampler(object):
         setattr(self, name, attr)
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
+        key = (ddim_num_steps, ddim_discretize, float(ddim_eta))
+        if key in self.schedule_cache:
+            for name, attr in self.schedule_cache[key].items():
+                setattr(self, name, attr)
+            return
+
         self.ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
                                                   num_ddpm_timesteps=self.ddpm_num_timesteps,verbose=verbose)
         alphas_cumprod = self.model.alphas_cumprod
@@ -51,6 +61,23 @@ class DDIMSampler(object):
                         1 - self.alphas_cumprod / self.alphas_cumprod_prev))
         self.register_buffer('ddim_sigmas_for_original_num_steps', sigmas_for_original_sampling_steps)
 
+        # per-step a_t, a_prev, sigma_t, sqrt_one_minus_at as one table indexed by the step,
+        # shaped to broadcast against the latents without a torch.full per step
+        to_cpu = lambda x: torch.as_tensor(np.asarray(x), dtype=torch.float32)
+        ddim_coeffs = torch.stack([to_cpu(ddim_alphas), to_cpu(ddim_alphas_prev), to_cpu(ddim_sigmas),
+                                   to_cpu(np.sqrt(1. - to_cpu(ddim_alphas)))], dim=1)
+        self.ddim_coeffs_host = ddim_coeffs.numpy()
+        self.register_buffer('ddim_coeffs', ddim_coeffs[:, :, None, None, None])
+
+        self.schedule_cache[key] = {
+            name: getattr(self, name) for name in (
+                'ddim_timesteps', 'betas', 'alphas_cumprod', 'alphas_cumprod_prev', 'sqrt_alphas_cumprod',
+                'sqrt_one_minus_alphas_cumprod', 'log_one_minus_alphas_cumprod', 'sqrt_recip_alphas_cumprod',
+                'sqrt_recipm1_alphas_cumprod', 'ddim_sigmas', 'ddim_alphas', 'ddim_alphas_prev',
+                'ddim_sqrt_one_minus_alphas', 'ddim_sigmas_for_original_num_steps', 'ddim_coeffs_host', 'ddim_coeffs',
+            )
+        }
+
     @torch.no_grad()
     def sample(self,
                S,
@@ -75,6 +102,7 @@ class DDIMSampler(object):
                unconditional_conditioning=None, # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
                dynamic_threshold=None,
                ucg_schedule=None,
+               keep_intermediates=True,
                **kwargs
                ):
         if conditioning is not None:
@@ -98,7 +126,8 @@ class DDIMSampler(object):
         # sampling
         C, H, W = shape
         size = (batch_size, C, H, W)
-        print(f'Data shape for DDIM sampling is {size}, eta {eta}')
+        if verbose:
+            print(f'Data shape for DDIM sampling is {size}, eta {eta}')
 
         samples, intermediates = self.ddim_sampling(conditioning, size,
                                                     callback=callback,
@@ -115,7 +144,9 @@ class DDIMSampler(object):
                                                     unconditional_guidance_scale=unconditional_guidance_scale,
                                                     unconditional_conditioning=unconditional_conditioning,
                                                     dynamic_threshold=dynamic_threshold,
-                                                    ucg_schedule=ucg_schedule
+                                                    ucg_schedule=ucg_schedule,
+                                                    keep_intermediates=keep_intermediates,
+                                                    verbose=verbose
                                                     )
         return samples, intermediates
 
@@ -126,7 +157,7 @@ class DDIMSampler(object):
                       mask=None, x0=None, img_callback=None, log_every_t=100,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
                       unconditional_guidance_scale=1., unconditional_conditioning=None, dynamic_threshold=None,
-                      ucg_schedule=None):
+                      ucg_schedule=None, keep_intermediates=True, verbose=True):
         device = self.model.betas.device
         b = shape[0]
         #x_T 1,4,64,64
@@ -141,12 +172,13 @@ class DDIMSampler(object):
             subset_end = int(min(timesteps / self.ddim_timesteps.shape[0], 1) * self.ddim_timesteps.shape[0]) - 1
             timesteps = self.ddim_timesteps[:subset_end]
 
-        intermediates = {'x_inter': [img], 'pred_x0': [img]}
+        intermediates = {'x_inter': [img], 'pred_x0': [img]} if keep_intermediates else {'x_inter': [], 'pred_x0': []}
         time_range = reversed(range(0,timesteps)) if ddim_use_original_steps else np.flip(timesteps)
         total_steps = timesteps if ddim_use_original_steps else timesteps.shape[0]
-        print(f"Running DDIM Sampling with {total_steps} timesteps")
+        if verbose:
+            print(f"Running DDIM Sampling with {total_steps} timesteps")
 
-        iterator = tqdm(time_range, desc='DDIM Sampler', total=total_steps)
+        iterator = tqdm(time_range, desc='DDIM Sampler', total=total_steps, disable=not verbose)
 
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
@@ -172,12 +204,31 @@ class DDIMSampler(object):
             if callback: callback(i)
             if img_callback: img_callback(pred_x0, i)
 
-            if index % log_every_t == 0 or index == total_steps - 1:
+            if keep_intermediates and (index % log_every_t == 0 or index == total_steps - 1):
                 intermediates['x_inter'].append(img)
                 intermediates['pred_x0'].append(pred_x0)
 
         return img, intermediates
 
+    @staticmethod
+    def cat_conditioning(c, uc):
+        # stacks cond and uncond along the batch dim, cond first
+        if isinstance(c, dict):
+            c_in = dict()
+            for k in c:
+                if uc[k] is None:
+                    # guess mode (c_concat=None for uncond): only the cond half gets a hint,
+                    # ControlLDM.apply_model runs no control for the samples past the hint batch
+                    c_in[k] = c[k]
+                elif isinstance(c[k], list):
+                    c_in[k] = [torch.cat([c[k][i], uc[k][i]]) for i in range(len(c[k]))]
+                else:
+                    c_in[k] = torch.cat([c[k], uc[k]])
+            return c_in
+        elif isinstance(c, list):
+            return [torch.cat([c[i], uc[i]]) for i in range(len(c))]
+        return torch.cat([c, uc])
+
     @torch.no_grad()
     def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
@@ -185,8 +236,14 @@ class DDIMSampler(object):
                       dynamic_threshold=None):
         b, *_, device = *x.shape, x.device
 
-        if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
+        # a (b, 1, 1, 1) tensor scale gives each sample of the batch its own guidance
+        if unconditional_conditioning is None or (not torch.is_tensor(unconditional_guidance_scale)
+                                                   and unconditional_guidance_scale == 1.):
             model_output = self.model.apply_model(x, t, c)
+        elif self.batched_cfg:
+            c_in = self.cat_conditioning(c, unconditional_conditioning)
+            model_t, model_uncond = self.model.apply_model(torch.cat([x, x]), torch.cat([t, t]), c_in).chunk(2)
+            model_output = model_uncond + unconditional_guidance_scale * (model_t - model_uncond)
         else:
             model_t = self.model.apply_model(x, t, c)
             model_uncond = self.model.apply_model(x, t, unconditional_conditioning)
@@ -201,15 +258,20 @@ class DDIMSampler(object):
             assert self.model.parameterization == "eps", 'not implemented'
             e_t = score_corrector.modify_score(self.model, e_t, x, t, c, **corrector_kwargs)
 
-        alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
-        alphas_prev = self.model.alphas_cumprod_prev if use_original_steps else self.ddim_alphas_prev
-        sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod if use_original_steps else self.ddim_sqrt_one_minus_alphas
-        sigmas = self.model.ddim_sigmas_for_original_num_steps if use_original_steps else self.ddim_sigmas
         # select parameters corresponding to the currently considered timestep
-        a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
-        a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
-        sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
-        sqrt_one_minus_at = torch.full((b, 1, 1, 1), sqrt_one_minus_alphas[index],device=device)
+        if use_original_steps:
+            alphas = self.model.alphas_cumprod
+            alphas_prev = self.model.alphas_cumprod_prev
+            sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod
+            sigmas = self.model.ddim_sigmas_for_original_num_steps
+            a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
+            a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
+            sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
+            sqrt_one_minus_at = torch.full((b, 1, 1, 1), sqrt_one_minus_alphas[index],device=device)
+            zero_noise = False
+        else:
+            a_t, a_prev, sigma_t, sqrt_one_minus_at = self.ddim_coeffs[index]
+            zero_noise = self.ddim_coeffs_host[index, 2] == 0. and noise_dropout == 0.
 
         # current prediction for x_0
         if self.model.parameterization != "v":
@@ -225,6 +287,9 @@ class DDIMSampler(object):
 
         # direction pointing to x_t
         dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
+        if zero_noise:
+            # eta=0: the noise term is multiplied by zero, skip sampling it
+            return a_prev.sqrt() * pred_x0 + dir_xt, pred_x0
         noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
         if noise_dropout > 0.:
             noise = torch.nn.functional.dropout(noise, p=noise_dropout)
@@ -0,0 +1,194 @@
+"""SAMPLING ONLY."""
+
+import math
+
+import torch
+import numpy as np
+from tqdm import tqdm
+
+from ldm.modules.diffusionmodules.util import make_ddim_timesteps
+from cldm.ddim_hacked import DDIMSampler
+
+
+class MultistepSampler(object):
+    """Common parts of the multistep data-prediction solvers (DPM-Solver++ 2M, UniPC).
+
+    Works on the same discrete timesteps as DDIMSampler (uniform spacing, last step lands on
+    t=0), so S steps cost S model evaluations and the result is directly comparable to DDIM.
+    """
+    name = None
+
+    def __init__(self, model, schedule="linear", batched_cfg=False, **kwargs):
+        super().__init__()
+        self.model = model
+        self.ddpm_num_timesteps = model.num_timesteps
+        self.schedule = schedule
+        self.batched_cfg = batched_cfg
+        # ddim_num_steps -> (timesteps, alphas, sigmas, lambdas) on the host
+        self.schedule_cache = dict()
+
+    def make_schedule(self, ddim_num_steps, verbose=True):
+        if ddim_num_steps in self.schedule_cache:
+            return self.schedule_cache[ddim_num_steps]
+        timesteps = make_ddim_timesteps(ddim_discr_method="uniform", num_ddim_timesteps=ddim_num_steps,
+                                        num_ddpm_timesteps=self.ddpm_num_timesteps, verbose=verbose)
+        timesteps = np.flip(timesteps).copy()
+        alphas_cumprod = self.model.alphas_cumprod.detach().cpu().double().numpy()
+        # evaluation points followed by the final target t=0, as for alphas_prev in DDIM
+        a_cum = np.concatenate([alphas_cumprod[timesteps], alphas_cumprod[:1]])
+        alphas = np.sqrt(a_cum)
+        sigmas = np.sqrt(1. - a_cum)
+        lambdas = np.log(alphas) - np.log(sigmas)
+        self.schedule_cache[ddim_num_steps] = (timesteps, alphas, sigmas, lambdas)
+        return self.schedule_cache[ddim_num_steps]
+
+    def model_x0(self, x, t, c, unconditional_guidance_scale, unconditional_conditioning, alpha, sigma):
+        # a (b, 1, 1, 1) tensor scale gives each sample of the batch its own guidance
+        if unconditional_conditioning is None or (not torch.is_tensor(unconditional_guidance_scale)
+                                                   and unconditional_guidance_scale == 1.):
+            model_output = self.model.apply_model(x, t, c)
+        elif self.batched_cfg:
+            c_in = DDIMSampler.cat_conditioning(c, unconditional_conditioning)
+            model_t, model_uncond = self.model.apply_model(torch.cat([x, x]), torch.cat([t, t]), c_in).chunk(2)
+            model_output = model_uncond + unconditional_guidance_scale * (model_t - model_uncond)
+        else:
+            model_t = self.model.apply_model(x, t, c)
+            model_uncond = self.model.apply_model(x, t, unconditional_conditioning)
+            model_output = model_uncond + unconditional_guidance_scale * (model_t - model_uncond)
+
+        if self.model.parameterization == "v":
+            return alpha * x - sigma * model_output
+        return (x - sigma * model_output) / alpha
+
+    @torch.no_grad()
+    def sample(self,
+               S,
+               batch_size,
+               shape,
+               conditioning=None,
+               callback=None,
+               img_callback=None,
+               verbose=True,
+               x_T=None,
+               unconditional_guidance_scale=1.,
+               unconditional_conditioning=None,
+               keep_intermediates=True,
+               **kwargs
+               ):
+        if conditioning is not None and isinstance(conditioning, dict):
+            ctmp = conditioning[list(conditioning.keys())[0]]
+            while isinstance(ctmp, list): ctmp = ctmp[0]
+            if ctmp.shape[0] != batch_size:
+                print(f"Warning: Got {ctmp.shape[0]} conditionings but batch-size is {batch_size}")
+
+        timesteps, alphas, sigmas, lambdas = self.make_schedule(S, verbose=verbose)
+        C, H, W = shape
+        size = (batch_size, C, H, W)
+        if verbose:
+            print(f'Data shape for {self.name} sampling is {size}')
+
+        device = self.model.betas.device
+        x = torch.randn(size, device=device) if x_T is None else x_T
+        intermediates = {'x_inter': [x], 'pred_x0': [x]} if keep_intermediates else {'x_inter': [], 'pred_x0': []}
+
+        x0_prev = None
+        iterator = tqdm(range(len(timesteps)), desc=f'{self.name} Sampler', total=len(timesteps), disable=not verbose)
+        for i in iterator:
+            ts = torch.full((batch_size,), timesteps[i], device=device, dtype=torch.long)
+            x0 = self.model_x0(x, ts, conditioning, unconditional_guidance_scale, unconditional_conditioning,
+                               float(alphas[i]), float(sigmas[i]))
+            x = self.step(i, x, x0, x0_prev, alphas, sigmas, lambdas)
+            x0_prev = x0
+            if callback: callback(i)
+            if img_callback: img_callback(x0, i)
+            if keep_intermediates:
+                intermediates['x_inter'].append(x)
+                intermediates['pred_x0'].append(x0)
+
+        return x, intermediates
+
+    def step(self, i, x, x0, x0_prev, alphas, sigmas, lambdas):
+        raise NotImplementedError()
+
+
+class DPMSolverSampler(MultistepSampler):
+    """DPM-Solver++(2M), https://arxiv.org/abs/2211.01095, first order on the first and last step."""
+    name = 'DPM-Solver++ 2M'
+
+    def step(self, i, x, x0, x0_prev, alphas, sigmas, lambdas):
+        h = lambdas[i + 1] - lambdas[i]
+        phi_1 = math.expm1(-h)
+        x_next = (sigmas[i + 1] / sigmas[i]) * x - (alphas[i + 1] * phi_1) * x0
+        if x0_prev is None or i == len(lambdas) - 2:
+            return x_next
+        r = (lambdas[i] - lambdas[i - 1]) / h
+        return x_next - (0.5 * alphas[i + 1] * phi_1 / r) * (x0 - x0_prev)
+
+
+class UniPCSampler(MultistepSampler):
+    """UniPC-2 with the B(h) = e^h - 1 variant (bh2), https://arxiv.org/abs/2302.04867.
+
+    The corrector reuses the model evaluation at the predicted point, so each step still costs
+    a single (CFG) model call; it is skipped after the last step where there is nothing to reuse.
+    """
+    name = 'UniPC'
+
+    def __init__(self, model, schedule="linear", batched_cfg=False, **kwargs):
+        super().__init__(model, schedule=schedule, batched_cfg=batched_cfg, **kwargs)
+        self.last_x = None
+        self.last_order = 1
+        self.x0_history = []
+
+    @staticmethod
+    def coefficients(h, order):
+        # R and b from the UniPC paper for the data-prediction (hh = -h) formulation
+        hh = -h
+        phi_1 = math.expm1(hh)
+        b_h = phi_1
+        phi_k = phi_1 / hh - 1.
+        factorial = 1
+        b = []
+        for k in range(1, order + 1):
+            b.append(phi_k * factorial / b_h)
+            factorial *= k + 1
+            phi_k = phi_k / hh - 1. / factorial
+        return phi_1, b_h, b
+
+    def correct(self, i, x0, x0_prev, x0_prev2, alphas, sigmas, lambdas):
+        # x0 is the model output at the predicted sample of step i; last_x/x0_prev belong to step i-1
+        h = lambdas[i] - lambdas[i - 1]
+        phi_1, b_h, b = self.coefficients(h, self.last_order)
+        x_t = (sigmas[i] / sigmas[i - 1]) * self.last_x - (alphas[i] * phi_1) * x0_prev
+        d1_t = x0 - x0_prev
+        if self.last_order == 1:
+            return x_t - (alphas[i] * b_h * 0.5) * d1_t
+        rk = (lambdas[i - 2] - lambdas[i - 1]) / h
+        rhos = np.linalg.solve(np.array([[1., 1.], [rk, 1.]]), np.array(b))
+        d1 = (x0_prev2 - x0_prev) / rk
+        return x_t - (alphas[i] * b_h) * (rhos[0] * d1 + rhos[1] * d1_t)
+
+    def predict(self, i, x, x0, x0_prev, order, alphas, sigmas, lambdas):
+        h = lambdas[i + 1] - lambdas[i]
+        phi_1, b_h, _ = self.coefficients(h, order)
+        x_next = (sigmas[i + 1] / sigmas[i]) * x - (alphas[i + 1] * phi_1) * x0
+        if order == 1:
+            return x_next
+        rk = (lambdas[i - 1] - lambdas[i]) / h
+        # order 2 has the closed form rho = 0.5
+        return x_next - (alphas[i + 1] * b_h * 0.5 / rk) * (x0_prev - x0)
+
+    @torch.no_grad()
+    def sample(self, *args, **kwargs):
+        self.last_x = None
+        self.x0_history = []
+        return super().sample(*args, **kwargs)
+
+    def step(self, i, x, x0, x0_prev, alphas, sigmas, lambdas):
+        if self.last_x is not None:
+            x0_prev2 = self.x0_history[-2] if len(self.x0_history) > 1 else None
+            x = self.correct(i, x0, x0_prev, x0_prev2, alphas, sigmas, lambdas)
+        self.x0_history = self.x0_history[-1:] + [x0]
+        order = 1 if x0_prev is None or i == len(lambdas) - 2 else 2
+        self.last_x = x
+        self.last_order = order
+        return self.predict(i, x, x0, x0_prev, order, alphas, sigmas, lambdas)
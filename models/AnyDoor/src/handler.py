@@ -15,13 +15,17 @@ from PIL import Image
 import io
 from io import BytesIO
 import base64
+import hashlib
+from collections import OrderedDict
 
 import runpod
 from PIL import Image
 import torchvision.transforms as T
 from datasets.data_utils import * 
-from cldm.model import create_model, load_state_dict
+from cldm.model import create_model, load_checkpoint
 from cldm.ddim_hacked import DDIMSampler
+from cldm.multistep_hacked import DPMSolverSampler, UniPCSampler
+from batching import DynamicBatcher, batch_guidance_scale, batch_noise
 from omegaconf import OmegaConf
 import functools
 from cldm.hack import disable_verbosity, enable_sliced_attention
@@ -42,18 +46,48 @@ model_ckpt = None
 use_interactive_seg = None
 model = None
 ddim_sampler = None
+samplers = None
+uncond_embedding = None
+# sha1 of the masked, cropped 224x224 reference -> DINOv2 embedding on the GPU (~1 MB each); the crop
+# ratio takes one of 4 values, so a repeated reference hits after a few jobs, seeded or not
+ref_embedding_cache = OrderedDict()
+REF_EMBEDDING_CACHE_SIZE = int(os.getenv("ANYDOOR_REF_CACHE_SIZE", 64))
 
 def initialize_model():
-    global config, model_ckpt, model_config, use_interactive_seg, model, ddim_sampler
+    global config, model_ckpt, model_config, use_interactive_seg, model, ddim_sampler, samplers, uncond_embedding
     config = OmegaConf.load('./configs/demo.yaml')
     model_ckpt =  config.pretrained_model
     model_config = config.config_file
     use_interactive_seg = config.config_file
 
-    model = create_model(model_config ).cpu()
-    model.load_state_dict(load_state_dict(model_ckpt, location='cuda'))
-    model = model.cuda()
-    ddim_sampler = DDIMSampler(model)
+    model = create_model(model_config ).cuda()
+    load_checkpoint(model, model_ckpt, location='cuda')
+    ddim_sampler = DDIMSampler(model, batched_cfg=True)
+    # selectable per job with "sampler"; the multistep solvers reach DDIM-50 quality in 15-20 steps
+    samplers = {
+        "ddim": ddim_sampler,
+        "dpmpp_2m": DPMSolverSampler(model, batched_cfg=True),
+        "unipc": UniPCSampler(model, batched_cfg=True),
+    }
+    # the unconditional branch always encodes an all-zeros reference, run the ViT-g once
+    with torch.no_grad():
+        uncond_embedding = model.get_learned_conditioning([torch.zeros((1,3,224,224))])
+
+def reference_embedding(ref):
+    key = hashlib.sha1(np.ascontiguousarray(ref).tobytes()).hexdigest()
+    if key in ref_embedding_cache:
+        ref_embedding_cache.move_to_end(key)
+        return ref_embedding_cache[key]
+
+    clip_input = torch.from_numpy(ref.copy()).float().cuda()
+    clip_input = einops.rearrange(clip_input[None], 'b h w c -> b c h w').clone()
+    with torch.no_grad():
+        embedding = model.get_learned_conditioning(clip_input)
+
+    ref_embedding_cache[key] = embedding
+    while len(ref_embedding_cache) > REF_EMBEDDING_CACHE_SIZE:
+        ref_embedding_cache.popitem(last=False)
+    return embedding
 
 # def init_iseg():
 #     global iseg_model
@@ -98,7 +132,7 @@ def crop_back( pred, tar_image,  extra_sizes, tar_box_yyxx_crop):
     tar_image[y1+m :y2-m, x1+m:x2-m, :] =  pred[m:-m, m:-m]
     return tar_image
 
-def inference_single_image(ref_image, 
+def prepare_single_image(ref_image, 
                             ref_mask, 
                             tar_image, 
                             tar_mask, 
@@ -107,38 +141,45 @@ def inference_single_image(ref_image,
                             scale, 
                             seed,
                             enable_shape_control,
+                            sampler = "ddim",
                             ):
-    raw_background = tar_image.copy()
-    item = process_pairs(ref_image, ref_mask, tar_image, tar_mask, enable_shape_control = enable_shape_control)
+    # the per-job CPU work; jobs whose batch_key matches can share one sampler call
+    if seed is None or seed < 0:
+        seed = random.randint(0, 65535)
+    item = process_pairs(ref_image, ref_mask, tar_image, tar_mask, enable_shape_control = enable_shape_control, seed = seed)
+    item.update(raw_background = tar_image.copy(), tar_image = tar_image, strength = strength,
+                ddim_steps = ddim_steps, scale = scale, seed = seed, sampler = sampler)
+    return item
 
-    ref = item['ref']
-    hint = item['hint']
-    num_samples = 1
+def batch_key(item):
+    return (item['strength'], item['ddim_steps'], item['sampler'])
 
-    control = torch.from_numpy(hint.copy()).float().cuda() 
-    control = torch.stack([control for _ in range(num_samples)], dim=0)
-    control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+def inference_batch(items):
+    # items share a batch_key; references, collages, seeds and guidance scales are per sample
+    num_samples = len(items)
+    first = items[0]
 
+    control = torch.stack([torch.from_numpy(item['hint'].copy()).float().cuda() for item in items], dim=0)
+    control = einops.rearrange(control, 'b h w c -> b c h w').clone()
 
-    clip_input = torch.from_numpy(ref.copy()).float().cuda() 
-    clip_input = torch.stack([clip_input for _ in range(num_samples)], dim=0)
-    clip_input = einops.rearrange(clip_input, 'b h w c -> b c h w').clone()
 
     H,W = 512,512
 
-    cond = {"c_concat": [control], "c_crossattn": [model.get_learned_conditioning( clip_input )]}
+    cond = {"c_concat": [control], "c_crossattn": [torch.cat([reference_embedding(item['ref']) for item in items])]}
     un_cond = {"c_concat": [control], 
-        "c_crossattn": [model.get_learned_conditioning([torch.zeros((1,3,224,224))] * num_samples)]}
+        "c_crossattn": [uncond_embedding.repeat(num_samples, 1, 1)]}
     shape = (4, H // 8, W // 8)
 
     if save_memory:
         model.low_vram_shift(is_diffusing=True)
 
-    model.control_scales = ([strength] * 13)
-    samples, _ = ddim_sampler.sample(ddim_steps, num_samples,
+    model.control_scales = ([first['strength']] * 13)
+    samples, _ = samplers[first['sampler']].sample(first['ddim_steps'], num_samples,
                                         shape, cond, verbose=False, eta=0,
-                                        unconditional_guidance_scale=scale,
-                                        unconditional_conditioning=un_cond)
+                                        x_T=batch_noise([item['seed'] for item in items], shape),
+                                        unconditional_guidance_scale=batch_guidance_scale([item['scale'] for item in items]),
+                                        unconditional_conditioning=un_cond,
+                                        keep_intermediates=False)
 
     if save_memory:
         model.low_vram_shift(is_diffusing=False)
@@ -146,21 +187,36 @@ def inference_single_image(ref_image,
     x_samples = model.decode_first_stage(samples)
     x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy()
 
-    result = x_samples[0][:,:,::-1]
-    result = np.clip(result,0,255)
+    results = []
+    for item, x_sample in zip(items, x_samples):
+        pred = np.clip(x_sample,0,255)[1:,:,:]
+        sizes = item['extra_sizes']
+        tar_box_yyxx_crop = item['tar_box_yyxx_crop'] 
+        tar_image = crop_back(pred, item['tar_image'], sizes, tar_box_yyxx_crop) 
 
-    pred = x_samples[0]
-    pred = np.clip(pred,0,255)[1:,:,:]
-    sizes = item['extra_sizes']
-    tar_box_yyxx_crop = item['tar_box_yyxx_crop'] 
-    tar_image = crop_back(pred, tar_image, sizes, tar_box_yyxx_crop) 
+        # keep background unchanged
+        raw_background = item['raw_background']
+        y1,y2,x1,x2 = item['tar_box_yyxx']
+        raw_background[y1:y2, x1:x2, :] = tar_image[y1:y2, x1:x2, :]
+        results.append(raw_background)
+    return results
 
-    # keep background unchanged
-    y1,y2,x1,x2 = item['tar_box_yyxx']
-    raw_background[y1:y2, x1:x2, :] = tar_image[y1:y2, x1:x2, :]
-    return raw_background
+def inference_single_image(ref_image, 
+                            ref_mask, 
+                            tar_image, 
+                            tar_mask, 
+                            strength, 
+                            ddim_steps, 
+                            scale, 
+                            seed,
+                            enable_shape_control,
+                            sampler = "ddim",
+                            ):
+    item = prepare_single_image(ref_image, ref_mask, tar_image, tar_mask, strength, ddim_steps, scale, seed,
+                                enable_shape_control, sampler)
+    return inference_batch([item])[0]
 
-def process_pairs(ref_image, ref_mask, tar_image, tar_mask, max_ratio = 0.8, enable_shape_control = False):
+def process_pairs(ref_image, ref_mask, tar_image, tar_mask, max_ratio = 0.8, enable_shape_control = False, seed = None):
     # ========= Reference ===========
     # ref expand 
     ref_box_yyxx = get_bbox_from_mask(ref_mask)
@@ -173,7 +229,10 @@ def process_pairs(ref_image, ref_mask, tar_image, tar_mask, max_ratio = 0.8, ena
     masked_ref_image = masked_ref_image[y1:y2,x1:x2,:]
     ref_mask = ref_mask[y1:y2,x1:x2]
 
-    ratio = np.random.randint(11, 15) / 10 #11,13
+    # random 1.1-1.4 augmentation, drawn from the job seed: the same reference and seed always give
+    # the same crop, other seeds (and unseeded jobs) land on one of the 4 ratios
+    rng = np.random if seed is None or seed < 0 else np.random.RandomState(int(seed))
+    ratio = rng.randint(11, 15) / 10 #11,13
     masked_ref_image, ref_mask = expand_image_mask(masked_ref_image, ref_mask, ratio=ratio)
     ref_mask_3 = np.stack([ref_mask,ref_mask,ref_mask],-1)
 
@@ -255,7 +314,7 @@ def mask_image(image, mask):
     return masked_image.astype(np.uint8)
 
 
-def run_local(base, ref, strength, ddim_steps, scale, seed, enable_shape_control):
+def prepare_local(base, ref, strength, ddim_steps, scale, seed, enable_shape_control, sampler = "ddim"):
     image = base["image"].convert("RGB")
     mask = base["mask"].convert("L")
     ref_image = ref["image"].convert("RGB")
@@ -268,11 +327,14 @@ def run_local(base, ref, strength, ddim_steps, scale, seed, enable_shape_control
     ref_mask = np.where(ref_mask > 128, 1, 0).astype(np.uint8)
     # ref_mask = process_image_mask(ref_image, ref_mask) ommitted considering the usage of SAM2
 
-    synthesis = inference_single_image(ref_image.copy(), ref_mask.copy(), image.copy(), mask.copy(), 
-                                        strength, ddim_steps, scale, seed, enable_shape_control)
-    synthesis = torch.from_numpy(synthesis).permute(2, 0, 1)
-    synthesis = synthesis.permute(1, 2, 0).numpy()
-    return [synthesis]
+    return prepare_single_image(ref_image.copy(), ref_mask.copy(), image.copy(), mask.copy(), 
+                                strength, ddim_steps, scale, seed, enable_shape_control, sampler)
+
+def run_local(base, ref, strength, ddim_steps, scale, seed, enable_shape_control, sampler = "ddim"):
+    item = prepare_local(base, ref, strength, ddim_steps, scale, seed, enable_shape_control, sampler)
+    return inference_batch([item])
+
+batcher = DynamicBatcher(inference_batch)
 
 def decode_base64_image(base64_string):
     img_data = base64.b64decode(base64_string)
@@ -283,7 +345,7 @@ def encode_pil_to_base64(pil_image):
     pil_image.save(buffered, format="PNG")
     return base64.b64encode(buffered.getvalue()).decode("utf-8")
 
-def handler(job):
+async def handler(job):
     job_input = job["input"]
 
     base_image = decode_base64_image(job_input["base_image"])
@@ -294,19 +356,25 @@ def handler(job):
     strength = job_input.get("image_scale", 1.0)
     ddim_steps = job_input.get("ddim_steps", 50)
     scale = job_input.get("guidance_scale", 7.5)
-    seed = job_input.get("seed", 42)
+    # seeds the noise and the reference crop ratio, -1 draws a random seed per job
+    seed = job_input.get("seed", -1)
     enable_shape_control = job_input.get("mode", False)
+    sampler = job_input.get("sampler", "ddim")
+    if sampler not in samplers:
+        raise ValueError(f"Unknown sampler '{sampler}', expected one of {sorted(samplers)}")
 
-    result = run_local(
+    item = prepare_local(
         {"image": base_image, "mask": base_mask},
         {"image": ref_image, "mask": ref_mask},
-        strength, ddim_steps, scale, seed, enable_shape_control
+        strength, ddim_steps, scale, seed, enable_shape_control, sampler
     )
+    # jobs with the same strength, steps and sampler arriving together share one sampler call
+    result = await batcher.submit(batch_key(item), item)
 
-    result_image = Image.fromarray(result[0])
+    result_image = Image.fromarray(result)
     result_b64 = encode_pil_to_base64(result_image)
     
     return {"image": result_b64}
 
 if __name__ == "__main__":
-    runpod.serverless.start({"handler": handler})
\ No newline at end of file
+    runpod.serverless.start({"handler": handler, "concurrency_modifier": batcher.concurrency_modifier})
\ No newline at end of file
@@ -6,7 +6,7 @@ import numpy as np
 from einops import rearrange
 from typing import Optional, Any
 
-from ldm.modules.attention import MemoryEfficientCrossAttention
+from ldm.modules.attention import MemoryEfficientCrossAttention, get_attn_mode
 
 try:
     import xformers
@@ -202,6 +202,25 @@ class AttnBlock(nn.Module):
 
         return x+h_
 
+class SDPAAttnBlock(AttnBlock):
+    """AttnBlock through torch's fused scaled_dot_product_attention (a single head over the
+    channels), without the (b, hw, hw) attention matrix. Same weights as AttnBlock."""
+    def forward(self, x):
+        h_ = x
+        h_ = self.norm(h_)
+        q = self.q(h_)
+        k = self.k(h_)
+        v = self.v(h_)
+
+        b,c,h,w = q.shape
+        q, k, v = map(lambda t: rearrange(t, 'b c h w -> b () (h w) c').contiguous(), (q, k, v))
+        h_ = torch.nn.functional.scaled_dot_product_attention(q, k, v)
+        h_ = rearrange(h_, 'b () (h w) c -> b c h w', h=h, w=w)
+
+        h_ = self.proj_out(h_)
+
+        return x+h_
+
 class MemoryEfficientAttnBlock(nn.Module):
     """
         Uses xformers efficient implementation,
@@ -278,13 +297,17 @@ class MemoryEfficientCrossAttentionWrapper(MemoryEfficientCrossAttention):
 
 
 def make_attn(in_channels, attn_type="vanilla", attn_kwargs=None):
-    assert attn_type in ["vanilla", "vanilla-xformers", "memory-efficient-cross-attn", "linear", "none"], f'attn_type {attn_type} unknown'
-    if XFORMERS_IS_AVAILBLE and attn_type == "vanilla":
-        attn_type = "vanilla-xformers"
+    assert attn_type in ["vanilla", "vanilla-sdpa", "vanilla-xformers", "memory-efficient-cross-attn", "linear", "none"], f'attn_type {attn_type} unknown'
+    if attn_type == "vanilla":
+        # same backend as the UNet attention, see ldm.modules.attention.get_attn_mode
+        attn_type = {"softmax-sdpa": "vanilla-sdpa", "softmax-xformers": "vanilla-xformers"}.get(get_attn_mode(), "vanilla")
     print(f"making attention of type '{attn_type}' with {in_channels} in_channels")
     if attn_type == "vanilla":
         assert attn_kwargs is None
         return AttnBlock(in_channels)
+    elif attn_type == "vanilla-sdpa":
+        assert attn_kwargs is None
+        return SDPAAttnBlock(in_channels)
     elif attn_type == "vanilla-xformers":
         print(f"building MemoryEfficientAttnBlock with {in_channels} in_channels...")
         return MemoryEfficientAttnBlock(in_channels)
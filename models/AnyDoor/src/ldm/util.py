@@ -1,4 +1,5 @@
 import importlib
+import os
 
 import torch
 from torch import optim
@@ -196,4 +197,39 @@ class AdamWwithEMAandWings(optim.Optimizer):
             for param, ema_param in zip(params_with_grad, ema_params_with_grad):
                 ema_param.mul_(cur_ema_decay).add_(param.float(), alpha=1 - cur_ema_decay)
 
-        return loss
\ No newline at end of file
+        return loss
+
+
+def safetensors_path(ckpt_path):
+    """Path of the converted checkpoint next to ckpt_path, see models/convert_to_safetensors.py."""
+    return os.path.splitext(ckpt_path)[0] + ".safetensors"
+
+
+def load_safetensors(model, path, strict=False):
+    """Stream a safetensors checkpoint into an instantiated model.
+
+    The file is memory-mapped and copied tensor by tensor into the parameters and buffers
+    wherever they already live (move the model to the GPU first to skip the host copy), so the
+    full state dict is never materialized. Returns (missing_keys, unexpected_keys).
+    """
+    from safetensors import safe_open
+    state = model.state_dict()
+    unexpected = []
+    with safe_open(path, framework="pt", device="cpu") as f:
+        keys = list(f.keys())
+        with torch.no_grad():
+            for key in keys:
+                if key not in state:
+                    unexpected.append(key)
+                    continue
+                tensor = f.get_tensor(key)
+                if tensor.shape != state[key].shape:
+                    raise RuntimeError(f"size mismatch for {key}: shape {tuple(tensor.shape)} in checkpoint, "
+                                       f"{tuple(state[key].shape)} in model")
+                state[key].copy_(tensor)
+    found = set(keys)
+    missing = [key for key in state if key not in found]
+    if strict and (missing or unexpected):
+        raise RuntimeError(f"Error(s) in loading {path} into {type(model).__name__}: "
+                           f"missing keys {missing}, unexpected keys {unexpected}")
+    return missing, unexpected
@@ -0,0 +1,73 @@
+import argparse
+import time
+
+import torch
+
+from ldm.modules.attention import CrossAttention, SDPACrossAttention
+from ldm.modules.diffusionmodules.model import AttnBlock, SDPAAttnBlock
+
+
+def timed(module, *args, device=None, repeats=10):
+    module(*args)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = module(*args)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if device.type == "cuda" else None
+    return out, (time.perf_counter() - start) / repeats, peak
+
+
+def compare(name, reference, sdpa, args, device, autocast, atol):
+    # both backends share the weights, only forward differs
+    sdpa.load_state_dict(reference.state_dict())
+    reference, sdpa = reference.to(device).eval(), sdpa.to(device).eval()
+    args = [arg.to(device) for arg in args]
+    # fp16 runs under autocast, as in the samplers
+    with torch.autocast(device.type, enabled=autocast):
+        ref_out, ref_time, ref_peak = timed(reference, *args, device=device)
+        out, sdpa_time, sdpa_peak = timed(sdpa, *args, device=device)
+    err = (out.float() - ref_out.float()).abs().max().item()
+    assert err <= atol, f"{name}: SDPA differs from the einsum attention by {err:.2e} (atol {atol:.0e})"
+    precision = "autocast" if autocast else "fp32"
+    memory = f", peak {ref_peak:8.1f} -> {sdpa_peak:8.1f} MiB" if device.type == "cuda" else ""
+    print(f"{name:28s} {precision:8s}: {ref_time * 1000:8.2f} ms -> {sdpa_time * 1000:8.2f} ms "
+          f"({ref_time / sdpa_time:5.1f}x){memory}, max abs err {err:.1e}")
+
+
+@torch.no_grad()
+def main(args):
+    device = torch.device(args.device)
+    autocasts = [False] + ([True] if device.type == "cuda" else [])
+    torch.manual_seed(0)
+    for resolution in args.resolutions:
+        # SD 1.5 at the first UNet level: 320 channels, 8 heads, one token per latent pixel
+        n = (resolution // 8) ** 2
+        x = torch.randn(args.batch_size, n, 320)
+        context = torch.randn(args.batch_size, 77, 768)
+        mask = torch.rand(args.batch_size, 77) > 0.2
+        mask[:, 0] = True
+        # the VAE mid block attends over the latent at 512 channels
+        h = torch.randn(args.batch_size, 512, resolution // 8, resolution // 8)
+        self_attn = dict(query_dim=320, heads=8, dim_head=40)
+        cross_attn = dict(query_dim=320, context_dim=768, heads=8, dim_head=40)
+        for autocast in autocasts:
+            atol = 2e-2 if autocast else 1e-4
+            compare(f"self-attention {n} tokens", CrossAttention(**self_attn), SDPACrossAttention(**self_attn),
+                    [x], device, autocast, atol)
+            compare(f"cross-attention {n}x77", CrossAttention(**cross_attn), SDPACrossAttention(**cross_attn),
+                    [x, context], device, autocast, atol)
+            compare("masked cross-attention", CrossAttention(**cross_attn), SDPACrossAttention(**cross_attn),
+                    [x, context, mask], device, autocast, atol)
+            compare(f"VAE AttnBlock {n} tokens", AttnBlock(512), SDPAAttnBlock(512), [h], device, autocast, atol)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the SDPA attention backend against the einsum one and time both")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[256, 512])
+    main(parser.parse_args())
@@ -2,7 +2,7 @@ import os
 import torch
 
 from omegaconf import OmegaConf
-from ldm.util import instantiate_from_config
+from ldm.util import instantiate_from_config, load_safetensors, safetensors_path
 
 
 def get_state_dict(d):
@@ -21,6 +21,17 @@ def load_state_dict(ckpt_path, location='cpu'):
     return state_dict
 
 
+def load_checkpoint(model, ckpt_path, location='cpu'):
+    # prefer the converted .safetensors next to the checkpoint, it is streamed into the model
+    fast_path = safetensors_path(ckpt_path)
+    if os.path.exists(fast_path):
+        load_safetensors(model, fast_path, strict=True)
+        print(f'Loaded state_dict from [{fast_path}]')
+    else:
+        model.load_state_dict(load_state_dict(ckpt_path, location=location))
+    return model
+
+
 def create_model(config_path):
     config = OmegaConf.load(config_path)
     model = instantiate_from_config(config.model).cpu()
@@ -0,0 +1,91 @@
+import argparse
+import time
+
+import cv2
+import einops
+import numpy as np
+import torch
+
+from annotator.util import resize_image, HWC3
+from annotator.canny import CannyDetector
+from cldm.model import create_model, load_state_dict
+from cldm.ddim_hacked import DDIMSampler
+from cldm.multistep_hacked import DPMSolverSampler, UniPCSampler
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255. ** 2 / mse)
+
+
+def run(model, sampler, steps, cond, un_cond, scale, x_T):
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    samples, _ = sampler.sample(steps, x_T.shape[0], tuple(x_T.shape[1:]), cond, verbose=False, eta=0.,
+                                unconditional_guidance_scale=scale, unconditional_conditioning=un_cond,
+                                x_T=x_T.clone(), keep_intermediates=False)
+    torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    x_samples = model.decode_first_stage(samples)
+    x_samples = (einops.rearrange(x_samples, 'b c h w -> b h w c') * 127.5 + 127.5).cpu().numpy().clip(0, 255)
+    return x_samples.astype(np.uint8), elapsed
+
+
+def main(args):
+    model = create_model(args.config).cpu()
+    model.load_state_dict(load_state_dict(args.ckpt, location='cuda'))
+    model = model.cuda()
+    samplers = {
+        "ddim": DDIMSampler(model, batched_cfg=True),
+        "dpmpp_2m": DPMSolverSampler(model, batched_cfg=True),
+        "unipc": UniPCSampler(model, batched_cfg=True),
+    }
+
+    img = resize_image(HWC3(cv2.imread(args.image)[:, :, ::-1]), args.resolution)
+    H, W, _ = img.shape
+    detected_map = HWC3(CannyDetector()(img, 100, 200))
+    control = torch.from_numpy(detected_map.copy()).float().cuda()[None] / 255.0
+    control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+    model.control_scales = [1.0] * 13
+
+    with torch.no_grad():
+        cond = {"c_concat": [control], "c_crossattn": [model.get_learned_conditioning([args.prompt + ', best quality, extremely detailed'])]}
+        un_cond = {"c_concat": [control], "c_crossattn": [model.get_learned_conditioning([args.n_prompt])]}
+
+        x_Ts = [torch.randn((1, 4, H // 8, W // 8), generator=torch.Generator().manual_seed(seed)).cuda()
+                for seed in args.seeds]
+        # warm up kernels before timing anything
+        run(model, samplers["ddim"], 2, cond, un_cond, args.scale, x_Ts[0])
+
+        references = [run(model, samplers["ddim"], args.reference_steps, cond, un_cond, args.scale, x_T)
+                      for x_T in x_Ts]
+        ref_time = np.median([t for _, t in references])
+        print(f"reference: ddim {args.reference_steps} steps, {ref_time:6.2f} s")
+
+        for name in args.samplers:
+            for steps in args.steps:
+                outs = [run(model, samplers[name], steps, cond, un_cond, args.scale, x_T) for x_T in x_Ts]
+                scores = [psnr(out, ref) for (out, _), (ref, _) in zip(outs, references)]
+                elapsed = np.median([t for _, t in outs])
+                print(f"{name:9s} {steps:3d} steps: {elapsed:6.2f} s ({ref_time / elapsed:4.1f}x), "
+                      f"PSNR vs reference {np.mean(scores):5.2f} dB (min {np.min(scores):5.2f})")
+                if args.save_dir:
+                    for seed, (out, _) in zip(args.seeds, outs):
+                        cv2.imwrite(f"{args.save_dir}/{name}_{steps}_{seed}.png", out[0][:, :, ::-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare DDIM, DPM-Solver++ 2M and UniPC against DDIM-50 on fixed seeds")
+    parser.add_argument("--config", type=str, default="./models/cldm_v15.yaml")
+    parser.add_argument("--ckpt", type=str, default="./models/control_sd15_canny.pth")
+    parser.add_argument("--image", type=str, required=True)
+    parser.add_argument("--prompt", type=str, default="a photo of a room")
+    parser.add_argument("--n_prompt", type=str, default="longbody, lowres, bad anatomy, bad hands, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality")
+    parser.add_argument("--resolution", type=int, default=512)
+    parser.add_argument("--scale", type=float, default=9.0)
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2, 3])
+    parser.add_argument("--reference_steps", type=int, default=50)
+    parser.add_argument("--samplers", type=str, nargs="+", default=["ddim", "dpmpp_2m", "unipc"])
+    parser.add_argument("--steps", type=int, nargs="+", default=[10, 15, 20, 25])
+    parser.add_argument("--save_dir", type=str, default=None, help="also write every sample as PNG here")
+    main(parser.parse_args())
@@ -9,19 +9,29 @@ import requests
 
 from io import BytesIO
 from PIL import Image
-from pytorch_lightning import seed_everything
 from annotator.util import resize_image, HWC3
 from annotator.canny import CannyDetector
-from cldm.model import create_model, load_state_dict
+from cldm.model import create_model, load_checkpoint
 from cldm.ddim_hacked import DDIMSampler
+from cldm.multistep_hacked import DPMSolverSampler, UniPCSampler
+from batching import DynamicBatcher, batch_guidance_scale, batch_noise
 
 
 apply_canny = CannyDetector()
 
-model = create_model('./models/cldm_v15.yaml').cpu()
-model.load_state_dict(load_state_dict('./models/control_sd15_canny.pth', location='cuda'))
-model = model.cuda()
-ddim_sampler = DDIMSampler(model)
+model = create_model('./models/cldm_v15.yaml').cuda()
+load_checkpoint(model, './models/control_sd15_canny.pth', location='cuda')
+default_a_prompt = "best quality, extremely detailed"
+default_n_prompt = "longbody, lowres, bad anatomy, bad hands, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality"
+# the negative prompt is the same for every job, encode it once; other prompts go through the encoder's LRU
+model.cond_stage_model.precompute([default_n_prompt])
+ddim_sampler = DDIMSampler(model, batched_cfg=True)
+# selectable per job with "sampler"; the multistep solvers reach DDIM-50 quality in 15-20 steps
+samplers = {
+    "ddim": ddim_sampler,
+    "dpmpp_2m": DPMSolverSampler(model, batched_cfg=True),
+    "unipc": UniPCSampler(model, batched_cfg=True),
+}
 
 class Config:
     def __init__(self):
@@ -43,37 +53,49 @@ def load_image(image_file: str):
     return image
 
 
-def process(input_image, prompt, a_prompt, n_prompt, num_samples, image_resolution, ddim_steps, guess_mode, strength, scale, seed, eta, low_threshold, high_threshold):
-    with torch.no_grad():
-        img = resize_image(HWC3(input_image), image_resolution)
-        H, W, C = img.shape
+def prepare(input_image, prompt, a_prompt, n_prompt, image_resolution, ddim_steps, guess_mode, strength, scale, seed, eta, low_threshold, high_threshold, sampler="ddim"):
+    # the per-job CPU work; jobs whose batch_key matches can share one sampler call
+    img = resize_image(HWC3(input_image), image_resolution)
+    detected_map = HWC3(apply_canny(img, low_threshold, high_threshold))
+    if seed == -1:
+        seed = random.randint(0, 65535)
+    return dict(detected_map=detected_map, prompt=prompt + ', ' + a_prompt, n_prompt=n_prompt, ddim_steps=ddim_steps,
+                guess_mode=guess_mode, strength=strength, scale=scale, seed=seed, eta=eta, sampler=sampler)
 
-        detected_map = apply_canny(img, low_threshold, high_threshold)
-        detected_map = HWC3(detected_map)
 
-        control = torch.from_numpy(detected_map.copy()).float().cuda() / 255.0
-        control = torch.stack([control for _ in range(num_samples)], dim=0)
-        control = einops.rearrange(control, 'b h w c -> b c h w').clone()
+def batch_key(item):
+    return (item["detected_map"].shape, item["ddim_steps"], item["guess_mode"], item["strength"], item["eta"], item["sampler"])
+
+
+def process_batch(items):
+    # items share a batch_key; prompts, control maps, seeds and guidance scales are per sample
+    num_samples = len(items)
+    first = items[0]
+    guess_mode = first["guess_mode"]
+    with torch.no_grad():
+        H, W, C = first["detected_map"].shape
 
-        if seed == -1:
-            seed = random.randint(0, 65535)
-        seed_everything(seed)
+        control = torch.stack([torch.from_numpy(item["detected_map"].copy()).float().cuda() / 255.0 for item in items], dim=0)
+        control = einops.rearrange(control, 'b h w c -> b c h w').clone()
 
         if config.save_memory:
             model.low_vram_shift(is_diffusing=False)
 
-        cond = {"c_concat": [control], "c_crossattn": [model.get_learned_conditioning([prompt + ', ' + a_prompt] * num_samples)]}
-        un_cond = {"c_concat": None if guess_mode else [control], "c_crossattn": [model.get_learned_conditioning([n_prompt] * num_samples)]}
+        cond = {"c_concat": [control], "c_crossattn": [model.get_learned_conditioning([item["prompt"] for item in items])]}
+        un_cond = {"c_concat": None if guess_mode else [control], "c_crossattn": [model.get_learned_conditioning([item["n_prompt"] for item in items])]}
         shape = (4, H // 8, W // 8)
 
         if config.save_memory:
             model.low_vram_shift(is_diffusing=True)
 
+        strength = first["strength"]
         model.control_scales = [strength * (0.825 ** float(12 - i)) for i in range(13)] if guess_mode else ([strength] * 13)  # Magic number. IDK why. Perhaps because 0.825**12<0.01 but 0.826**12>0.01
-        samples, intermediates = ddim_sampler.sample(ddim_steps, num_samples,
-                                                     shape, cond, verbose=False, eta=eta,
-                                                     unconditional_guidance_scale=scale,
-                                                     unconditional_conditioning=un_cond)
+        samples, intermediates = samplers[first["sampler"]].sample(first["ddim_steps"], num_samples,
+                                                                   shape, cond, verbose=False, eta=first["eta"],
+                                                                   x_T=batch_noise([item["seed"] for item in items], shape),
+                                                                   unconditional_guidance_scale=batch_guidance_scale([item["scale"] for item in items]),
+                                                                   unconditional_conditioning=un_cond,
+                                                                   keep_intermediates=False)
 
         if config.save_memory:
             model.low_vram_shift(is_diffusing=False)
@@ -86,7 +108,10 @@ def process(input_image, prompt, a_prompt, n_prompt, num_samples, image_resoluti
     return results
 
 
-def handler(job):
+batcher = DynamicBatcher(process_batch)
+
+
+async def handler(job):
     job_input = job["input"]
 
     image = np.asarray(load_image(job_input["base_image"]))
@@ -97,23 +122,28 @@ def handler(job):
     low_tresh = 50
     high_thresh = 200
     steps = int(job_input["ddim_steps"])
+    sampler = job_input.get("sampler", "ddim")
+    if sampler not in samplers:
+        raise ValueError(f"Unknown sampler '{sampler}', expected one of {sorted(samplers)}")
 
-    generated_image = Image.fromarray(process(
+    item = prepare(
         input_image = image,
         prompt = prompt,
-        a_prompt = "best quality, extremely detailed",
-        n_prompt = "longbody, lowres, bad anatomy, bad hands, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality",
-        num_samples = 1,
+        a_prompt = default_a_prompt,
+        n_prompt = default_n_prompt,
         image_resolution = image_resolution,
         ddim_steps = steps,
         guess_mode = False,
         strength = strength,
         scale = scale,
-        seed = -1,
+        seed = int(job_input.get("seed", -1)),
         eta = 0.0,
         low_threshold = low_tresh,
-        high_threshold = high_thresh
-    )[0], "RGB")
+        high_threshold = high_thresh,
+        sampler = sampler
+    )
+    # jobs with the same resolution, steps, strength and sampler arriving together share one sampler call
+    generated_image = Image.fromarray(await batcher.submit(batch_key(item), item), "RGB")
 
     bytes = BytesIO()
     generated_image.save(bytes, format = "PNG")
@@ -121,4 +151,4 @@ def handler(job):
     return base64.b64encode(bytes.getvalue()).decode("utf-8")
 
 if __name__ == '__main__':
-    runpod.serverless.start({'handler': handler})
\ No newline at end of file
+    runpod.serverless.start({'handler': handler, 'concurrency_modifier': batcher.concurrency_modifier})
\ No newline at end of file
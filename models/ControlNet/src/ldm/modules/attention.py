@@ -16,13 +16,25 @@ try:
 except:
     XFORMERS_IS_AVAILBLE = False
 
+SDPA_IS_AVAILABLE = hasattr(F, "scaled_dot_product_attention")
+
 # CrossAttn precision handling
 import os
 _ATTN_PRECISION = os.environ.get("ATTN_PRECISION", "fp32")
+ATTN_MODE = os.environ.get("ATTN_MODE")
+
 
 def exists(val):
     return val is not None
 
+def get_attn_mode():
+    """ATTN_MODE picks one of BasicTransformerBlock.ATTENTION_MODES, by default the fastest one installed."""
+    if ATTN_MODE is not None:
+        return ATTN_MODE
+    if XFORMERS_IS_AVAILBLE:
+        return "softmax-xformers"
+    return "softmax-sdpa" if SDPA_IS_AVAILABLE else "softmax"
+
 
 def uniq(arr):
     return{el: True for el in arr}.keys()
@@ -194,6 +206,27 @@ class CrossAttention(nn.Module):
         return self.to_out(out)
 
 
+class SDPACrossAttention(CrossAttention):
+    """CrossAttention through torch's fused scaled_dot_product_attention, which never materializes
+    the (b*h, n, n) similarity matrix and accumulates in fp32 regardless of the input dtype."""
+    def forward(self, x, context=None, mask=None):
+        h = self.heads
+
+        q = self.to_q(x)
+        context = default(context, x)
+        k = self.to_k(context)
+        v = self.to_v(context)
+
+        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=h), (q, k, v))
+
+        if exists(mask):
+            mask = rearrange(mask, 'b ... -> b () () (...)')
+
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+        out = rearrange(out, 'b h n d -> b n (h d)')
+        return self.to_out(out)
+
+
 class MemoryEfficientCrossAttention(nn.Module):
     # https://github.com/MatthieuTPHR/diffusers/blob/d80b531ff8060ec1ea982b65a1b8df70f73aa67c/src/diffusers/models/attention.py#L223
     def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0.0):
@@ -246,12 +279,13 @@ class MemoryEfficientCrossAttention(nn.Module):
 class BasicTransformerBlock(nn.Module):
     ATTENTION_MODES = {
         "softmax": CrossAttention,  # vanilla attention
+        "softmax-sdpa": SDPACrossAttention,
         "softmax-xformers": MemoryEfficientCrossAttention
     }
     def __init__(self, dim, n_heads, d_head, dropout=0., context_dim=None, gated_ff=True, checkpoint=True,
                  disable_self_attn=False):
         super().__init__()
-        attn_mode = "softmax-xformers" if XFORMERS_IS_AVAILBLE else "softmax"
+        attn_mode = get_attn_mode()
         assert attn_mode in self.ATTENTION_MODES
         attn_cls = self.ATTENTION_MODES[attn_mode]
         self.disable_self_attn = disable_self_attn
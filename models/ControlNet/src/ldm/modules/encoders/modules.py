@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
 from torch.utils.checkpoint import checkpoint
@@ -93,7 +95,7 @@ class FrozenCLIPEmbedder(AbstractEncoder):
         "hidden"
     ]
     def __init__(self, version="openai/clip-vit-large-patch14", device="cuda", max_length=77,
-                 freeze=True, layer="last", layer_idx=None):  # clip-vit-base-patch32
+                 freeze=True, layer="last", layer_idx=None, cache_size=256):  # clip-vit-base-patch32
         super().__init__()
         assert layer in self.LAYERS
         self.tokenizer = CLIPTokenizer.from_pretrained(version)
@@ -107,6 +109,14 @@ class FrozenCLIPEmbedder(AbstractEncoder):
         if layer == "hidden":
             assert layer_idx is not None
             assert 0 <= abs(layer_idx) <= 12
+        # per-prompt LRU of encoded prompts, (1, max_length, d) tensors on self.device;
+        # only a frozen encoder gives the same embedding for the same text
+        self.cache = OrderedDict()
+        self.cache_size = cache_size if freeze else 0
+        # constant prompts from precompute(), never evicted
+        self.pinned = dict()
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     def freeze(self):
         self.transformer = self.transformer.eval()
@@ -127,8 +137,43 @@ class FrozenCLIPEmbedder(AbstractEncoder):
             z = outputs.hidden_states[self.layer_idx]
         return z
 
+    def cache_key(self, text):
+        # fp16 and fp32 encodings of the same prompt are kept apart
+        return (text, self.max_length, self.layer, self.layer_idx, torch.is_autocast_enabled())
+
+    def lookup(self, key):
+        if key in self.pinned:
+            return self.pinned[key]
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        return None
+
     def encode(self, text):
-        return self(text)
+        if self.cache_size == 0:
+            return self(text)
+        if isinstance(text, str):
+            text = [text]
+        keys = [self.cache_key(t) for t in text]
+        found = {k: self.lookup(k) for k in keys}
+        missing = [k for k, z in found.items() if z is None]
+        self.cache_misses += sum(found[k] is None for k in keys)
+        self.cache_hits += sum(found[k] is not None for k in keys)
+        if missing:
+            # all new prompts in one forward, duplicates in the batch are encoded once
+            z = self([k[0] for k in missing])
+            for i, k in enumerate(missing):
+                found[k] = self.cache[k] = z[i:i + 1].clone()
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return torch.cat([found[k] for k in keys])
+
+    @torch.no_grad()
+    def precompute(self, text):
+        """Encode constant prompts (negative prompt, null prompt) once, they are never evicted."""
+        z = self(text)
+        for i, t in enumerate(text):
+            self.pinned[self.cache_key(t)] = z[i:i + 1].clone()
 
 
 class FrozenOpenCLIPEmbedder(AbstractEncoder):
@@ -0,0 +1,70 @@
+import argparse
+import base64
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+# loads the model and builds the denoiser wrappers, like a worker would
+import handler
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if mse == 0 else 10 * np.log10(255. ** 2 / mse)
+
+
+def decode(image_b64):
+    return np.array(Image.open(BytesIO(base64.b64decode(image_b64))).convert("RGB"))
+
+
+def run(image_b64, args, cfg_image, **modes):
+    edits = [(args.edit, args.cfg_text, cfg_image, seed) for seed in args.seeds]
+    start = time.perf_counter()
+    outs = handler.run_edits(image_b64, args.resolution, args.steps, edits, **modes)
+    elapsed = time.perf_counter() - start
+    return [decode(out) for out in outs], elapsed, handler.model_wrap_cfg.unet_evals, handler.model_wrap_cfg.full_evals
+
+
+def main(args):
+    with open(args.input, "rb") as f:
+        image_b64 = base64.b64encode(f.read()).decode("utf-8")
+
+    # warm up kernels before timing anything
+    run(image_b64, argparse.Namespace(**{**vars(args), "steps": 2}), args.cfg_image)
+
+    reference, ref_time, _, _ = run(image_b64, args, args.cfg_image)
+    print(f"three-way       : {ref_time:6.2f} s")
+
+    # image_cfg 1 drops the uncond branch exactly, it has no three-way output to compare against
+    _, elapsed, evals, full_evals = run(image_b64, args, 1.)
+    print(f"image_cfg 1     : {elapsed:6.2f} s, UNet evaluations {evals:4d} of {full_evals:4d} "
+          f"({1 - evals / full_evals:4.0%} saved), exact")
+
+    modes = [(f"interval {f:.2f}", {"guidance_interval": f}) for f in args.intervals]
+    modes += [(f"image every {k}", {"image_guidance_every": k}) for k in args.every]
+    for name, kwargs in modes:
+        outs, elapsed, evals, full_evals = run(image_b64, args, args.cfg_image, **kwargs)
+        scores = [psnr(out, ref) for out, ref in zip(outs, reference)]
+        print(f"{name:16s}: {elapsed:6.2f} s, UNet evaluations {evals:4d} of {full_evals:4d} "
+              f"({1 - evals / full_evals:4.0%} saved), PSNR vs three-way {np.mean(scores):5.2f} dB "
+              f"(min {np.min(scores):5.2f})")
+        if args.save_dir:
+            for seed, out in zip(args.seeds, outs):
+                Image.fromarray(out).save(f"{args.save_dir}/{name.replace(' ', '_')}_{seed}.png")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the reduced-cost IP2P guidance modes against full three-way guidance on fixed seeds")
+    parser.add_argument("--input", type=str, required=True)
+    parser.add_argument("--edit", type=str, default="turn him into a cyborg")
+    parser.add_argument("--resolution", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--cfg_text", type=float, default=7.5)
+    parser.add_argument("--cfg_image", type=float, default=1.5)
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2, 3])
+    parser.add_argument("--intervals", type=float, nargs="+", default=[0.1, 0.2, 0.3])
+    parser.add_argument("--every", type=int, nargs="+", default=[2, 3])
+    parser.add_argument("--save_dir", type=str, default=None, help="also write every sample as PNG here")
+    main(parser.parse_args())
@@ -1,8 +1,10 @@
 from __future__ import annotations
 
 import math
+import os
 import random
 import sys
+import time
 
 import einops
 import k_diffusion as K
@@ -21,49 +23,162 @@ import requests
 from fastapi import Response
 sys.path.append("./stable_diffusion")
 
-from stable_diffusion.ldm.util import instantiate_from_config
+from stable_diffusion.ldm.util import instantiate_from_config, load_safetensors, safetensors_path
 
 class CFGDenoiser(nn.Module):
+    """Three-way IP2P guidance over the cond, image-only and uncond branches.
+
+    Branches that do not contribute are skipped: only cond and image-only are evaluated when
+    image_cfg_scale == 1, only cond when both scales are 1 or once guidance_steps steps are done
+    (guidance interval), and with image_guidance_every=k the image-only branch is evaluated every
+    k-th step and replaced by uncond + its last image guidance direction in between. unet_evals and
+    full_evals count branch evaluations per sample with and without these shortcuts.
+    """
     def __init__(self, model):
         super().__init__()
         self.inner_model = model
+        self.reset()
+
+    def reset(self):
+        # call before every sampling run, the step counter and the cached direction are per run
+        self.step = 0
+        self.img_delta = None
+        self.unet_evals = 0
+        self.full_evals = 0
+
+    def forward(self, z, sigma, cond, uncond, text_cfg_scale, image_cfg_scale, guidance_steps=None,
+                image_guidance_every=1):
+        # z is (n, ...); conditionings with a batch of 1 (the shared image latent, the null
+        # prompt) are broadcast to n, the scales are floats or (n, 1, 1, 1) tensors
+        n = z.shape[0]
+        expand = lambda c: c.expand(n, *c.shape[1:])
+        is_one = lambda scale: not torch.is_tensor(scale) and scale == 1.
+        branches = {
+            "cond": (cond["c_crossattn"][0], cond["c_concat"][0]),
+            "img_cond": (uncond["c_crossattn"][0], cond["c_concat"][0]),
+            "uncond": (uncond["c_crossattn"][0], uncond["c_concat"][0]),
+        }
+        past_interval = guidance_steps is not None and self.step >= guidance_steps
+        if past_interval or (is_one(text_cfg_scale) and is_one(image_cfg_scale)):
+            names = ["cond"]
+        elif is_one(image_cfg_scale):
+            names = ["cond", "img_cond"]
+        elif self.img_delta is not None and self.step % image_guidance_every:
+            names = ["cond", "uncond"]
+        else:
+            names = ["cond", "img_cond", "uncond"]
 
-    def forward(self, z, sigma, cond, uncond, text_cfg_scale, image_cfg_scale):
-        cfg_z = einops.repeat(z, "1 ... -> n ...", n=3)
-        cfg_sigma = einops.repeat(sigma, "1 ... -> n ...", n=3)
+        cfg_z = einops.repeat(z, "n ... -> (r n) ...", r=len(names))
+        cfg_sigma = einops.repeat(sigma, "n ... -> (r n) ...", r=len(names))
         cfg_cond = {
-            "c_crossattn": [torch.cat([cond["c_crossattn"][0], uncond["c_crossattn"][0], uncond["c_crossattn"][0]])],
-            "c_concat": [torch.cat([cond["c_concat"][0], cond["c_concat"][0], uncond["c_concat"][0]])],
+            "c_crossattn": [torch.cat([expand(branches[name][0]) for name in names])],
+            "c_concat": [torch.cat([expand(branches[name][1]) for name in names])],
         }
-        out_cond, out_img_cond, out_uncond = self.inner_model(cfg_z, cfg_sigma, cond=cfg_cond).chunk(3)
+        out = dict(zip(names, self.inner_model(cfg_z, cfg_sigma, cond=cfg_cond).chunk(len(names))))
+        self.step += 1
+        self.unet_evals += len(names)
+        self.full_evals += 3
+
+        if names == ["cond"]:
+            return out["cond"]
+        if is_one(image_cfg_scale):
+            return out["img_cond"] + text_cfg_scale * (out["cond"] - out["img_cond"])
+        if "img_cond" in out:
+            self.img_delta = out["img_cond"] - out["uncond"]
+        else:
+            out["img_cond"] = out["uncond"] + self.img_delta
+        out_cond, out_img_cond, out_uncond = out["cond"], out["img_cond"], out["uncond"]
         return out_uncond + text_cfg_scale * (out_cond - out_img_cond) + image_cfg_scale * (out_img_cond - out_uncond)
 
 def load_model_from_config(config, ckpt, vae_ckpt=None, verbose=False):
-    print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
-    if "global_step" in pl_sd:
-        print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
-    if vae_ckpt is not None:
-        print(f"Loading VAE from {vae_ckpt}")
-        vae_sd = torch.load(vae_ckpt, map_location="cpu")["state_dict"]
-        sd = {
-            k: vae_sd[k[len("first_stage_model.") :]] if k.startswith("first_stage_model.") else v
-            for k, v in sd.items()
-        }
     model = instantiate_from_config(config.model)
-    m, u = model.load_state_dict(sd, strict=False)
+    if vae_ckpt is None and os.path.exists(safetensors_path(ckpt)):
+        # converted with models/convert_to_safetensors.py, memory-mapped and streamed into the model
+        print(f"Loading model from {safetensors_path(ckpt)}")
+        m, u = load_safetensors(model, safetensors_path(ckpt))
+    else:
+        print(f"Loading model from {ckpt}")
+        pl_sd = torch.load(ckpt, map_location="cpu")
+        if "global_step" in pl_sd:
+            print(f"Global Step: {pl_sd['global_step']}")
+        sd = pl_sd["state_dict"]
+        if vae_ckpt is not None:
+            print(f"Loading VAE from {vae_ckpt}")
+            vae_sd = torch.load(vae_ckpt, map_location="cpu")["state_dict"]
+            sd = {
+                k: vae_sd[k[len("first_stage_model.") :]] if k.startswith("first_stage_model.") else v
+                for k, v in sd.items()
+            }
+        m, u = model.load_state_dict(sd, strict=False)
     if len(m) > 0 and verbose:
         print("missing keys:")
         print(m)
     if len(u) > 0 and verbose:
         print("unexpected keys:")
         print(u)
+    # serve with the EMA weights baked in, ema_scope() is a no-op afterwards; checkpoints
+    # converted with --bake-ema have no model_ema.* keys, their weights already are the EMA ones
+    model.bake_ema(copy=not any(k.startswith("model_ema.") for k in m))
     return model
 
 # load model
 config = OmegaConf.load("configs/generate.yaml")
 model = load_model_from_config(config, "checkpoints/instruct-pix2pix-00-22000.ckpt", None)
+model.eval().cuda()
+# the null prompt is encoded once here, edit prompts go through the encoder's LRU
+model.cond_stage_model.precompute([""])
+
+# everything below only depends on the weights, build it once for the lifetime of the worker
+model_wrap = K.external.CompVisDenoiser(model)
+model_wrap_cfg = CFGDenoiser(model_wrap)
+with torch.no_grad():
+    null_token = model.get_learned_conditioning([""])
+
+# steps -> k-diffusion sigma schedule, the common step counts are filled in up front
+sigmas_cache = {}
+def get_sigmas(steps):
+    if steps not in sigmas_cache:
+        sigmas_cache[steps] = model_wrap.get_sigmas(steps)
+    return sigmas_cache[steps]
+
+for steps in os.getenv("IP2P_SIGMA_STEPS", "20,30,50,100").split(","):
+    get_sigmas(int(steps))
+
+class StageTimer:
+    """Wall time per stage of one job, synchronized with the GPU at every stage boundary."""
+    def __init__(self):
+        self.times = {}
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.times[stage] = now - self.last
+        self.last = now
+
+    def __str__(self):
+        stages = ", ".join(f"{stage} {t * 1000:.0f} ms" for stage, t in self.times.items())
+        return f"{stages} (total {sum(self.times.values()) * 1000:.0f} ms)"
+
+IP2P_MAX_EDITS = int(os.getenv("IP2P_MAX_EDITS", 8))
+
+def guidance_scale(scales):
+    # a float when all edits agree, else one scale per sample of the batch
+    if len(set(scales)) == 1:
+        return float(scales[0])
+    return torch.tensor(scales, dtype=torch.float32, device=model.device).view(-1, 1, 1, 1)
+
+class SeededNoise:
+    """k-diffusion noise sampler with one generator per sample, so every edit of a batch draws
+    the same noise as a single edit run after torch.manual_seed(seed)."""
+    def __init__(self, seeds, latent):
+        self.generators = [torch.Generator(device=latent.device).manual_seed(int(seed)) for seed in seeds]
+        self.latent = latent
+
+    def __call__(self, sigma=None, sigma_next=None):
+        latent = self.latent
+        return torch.cat([torch.randn(latent.shape, generator=g, device=latent.device, dtype=latent.dtype)
+                          for g in self.generators])
 
 # util functions
 def load_image_from_base64(base64_str: str):
@@ -80,15 +195,28 @@ def load_image(image_file: str):
     return image
 
 # inference functions for running model inference takes in image (as url) and some params, outputs in base64 encoded image
-def run_inference(image_url: str, resolution: int, steps: int, cfg_text: float, cfg_image: float, edit_prompt: str, seed):
-    model.eval().cuda()
-    model_wrap = K.external.CompVisDenoiser(model)
-    model_wrap_cfg = CFGDenoiser(model_wrap)
-    null_token = model.get_learned_conditioning([""])
+def run_inference(image_url: str, resolution: int, steps: int, cfg_text: float, cfg_image: float, edit_prompt: str, seed,
+                  guidance_interval: float = 0., image_guidance_every: int = 1):
+    return run_edits(image_url, resolution, steps, [(edit_prompt, cfg_text, cfg_image, seed)],
+                     guidance_interval=guidance_interval, image_guidance_every=image_guidance_every)[0]
 
-    seed = random.randint(0, 100000) if seed is None else seed
+# several edits of the same image: the image latent is encoded once and all edits are sampled as one batch;
+# guidance_interval is the fraction of the last steps sampled without guidance (cond branch only),
+# image_guidance_every the number of steps an image guidance direction is reused for
+def run_edits(image_url: str, resolution: int, steps: int, edits, guidance_interval: float = 0.,
+              image_guidance_every: int = 1):
+    if not 0 < len(edits) <= IP2P_MAX_EDITS:
+        raise ValueError(f"Expected between 1 and {IP2P_MAX_EDITS} edits per job, got {len(edits)}")
+    if not 0. <= guidance_interval <= 1.:
+        raise ValueError(f"guidance_interval is a fraction of the steps between 0 and 1, got {guidance_interval}")
+    if image_guidance_every < 1:
+        raise ValueError(f"image_guidance_every must be at least 1, got {image_guidance_every}")
+    timer = StageTimer()
+    edit_prompts = [edit_prompt for edit_prompt, _, _, _ in edits]
+    seeds = [random.randint(0, 100000) if seed is None else seed for _, _, _, seed in edits]
 
     input_image = load_image(image_url)
+    timer.lap("load")
 
     width, height = input_image.size
     factor = resolution / max(width, height)
@@ -96,38 +224,53 @@ def run_inference(image_url: str, resolution: int, steps: int, cfg_text: float,
     width = int((width * factor) // 64) * 64
     height = int((height * factor) // 64) * 64
     input_image = ImageOps.fit(input_image, (width, height), method=Image.Resampling.LANCZOS)
+    timer.lap("resize")
 
     with torch.no_grad(), autocast("cuda"), model.ema_scope():
         cond = {}
-        cond["c_crossattn"] = [model.get_learned_conditioning([edit_prompt])]
+        cond["c_crossattn"] = [model.get_learned_conditioning(edit_prompts)]
+        timer.lap("text_encode")
         input_image = 2 * torch.tensor(np.array(input_image)).float() / 255 - 1
         input_image = rearrange(input_image, "h w c -> 1 c h w").to(model.device)
         cond["c_concat"] = [model.encode_first_stage(input_image).mode()]
+        timer.lap("image_encode")
 
         uncond = {}
         uncond["c_crossattn"] = [null_token]
         uncond["c_concat"] = [torch.zeros_like(cond["c_concat"][0])]
 
-        sigmas = model_wrap.get_sigmas(steps)
+        sigmas = get_sigmas(steps)
 
         extra_args = {
             "cond": cond,
             "uncond": uncond,
-            "text_cfg_scale": cfg_text,
-            "image_cfg_scale": cfg_image,
+            "text_cfg_scale": guidance_scale([cfg_text for _, cfg_text, _, _ in edits]),
+            "image_cfg_scale": guidance_scale([cfg_image for _, _, cfg_image, _ in edits]),
+            "guidance_steps": steps - round(guidance_interval * steps),
+            "image_guidance_every": image_guidance_every,
         }
-        torch.manual_seed(seed)
-        z = torch.randn_like(cond["c_concat"][0]) * sigmas[0]
-        z = K.sampling.sample_euler_ancestral(model_wrap_cfg, z, sigmas, extra_args=extra_args)
+        model_wrap_cfg.reset()
+        noise = SeededNoise(seeds, cond["c_concat"][0])
+        z = noise() * sigmas[0]
+        z = K.sampling.sample_euler_ancestral(model_wrap_cfg, z, sigmas, extra_args=extra_args, noise_sampler=noise)
+        timer.lap("sample")
         x = model.decode_first_stage(z)
         x = torch.clamp((x + 1.0) / 2.0, min=0.0, max=1.0)
-        x = 255.0 * rearrange(x, "1 c h w -> h w c")
-        edited_image = Image.fromarray(x.type(torch.uint8).cpu().numpy()).resize((width, height))
+        x = 255.0 * rearrange(x, "n c h w -> n h w c")
+        edited_images = [Image.fromarray(img).resize((width, height)) for img in x.type(torch.uint8).cpu().numpy()]
+        timer.lap("decode")
 
-    bytes = BytesIO()
-    edited_image.save(bytes, format = "PNG")
+    encoded = []
+    for edited_image in edited_images:
+        bytes = BytesIO()
+        edited_image.save(bytes, format = "PNG")
+        encoded.append(base64.b64encode(bytes.getvalue()).decode("utf-8"))
+    timer.lap("png")
+    print(f"run_edits {width}x{height}, {len(edits)} edits, {steps} steps: {timer}")
+    print(f"UNet evaluations per edit: {model_wrap_cfg.unet_evals} of {model_wrap_cfg.full_evals} "
+          f"({model_wrap_cfg.full_evals - model_wrap_cfg.unet_evals} saved)")
 
-    return base64.b64encode(bytes.getvalue()).decode("utf-8")
+    return encoded
 
 """
 {
@@ -141,16 +284,45 @@ def run_inference(image_url: str, resolution: int, steps: int, cfg_text: float,
     "seed": null
   }
 }
+
+optional, trade some fidelity for fewer UNet evaluations: "guidance_interval": 0.2 samples the last 20%
+of the steps without guidance, "image_guidance_every": 2 evaluates the image-only branch every other step
+
+several edits of one image in a single batched pass, returns a list of images in the order of "edits":
+{
+  "input": {
+    "base_image": "<url or base64>",
+    "ddim_steps": 50,
+    "edits": [
+      {"target_prompt": "make it winter", "text_scale": 7.5, "image_scale": 1.5, "seed": 1},
+      ["turn the bear into an elephant", 7.5, 1.2, null]
+    ]
+  }
+}
 """
 
+def parse_edit(edit):
+    if isinstance(edit, dict):
+        edit = (edit["target_prompt"], edit["text_scale"], edit["image_scale"], edit.get("seed"))
+    edit_prompt, cfg_text, cfg_img, seed = edit
+    return str(edit_prompt), float(cfg_text), float(cfg_img), None if seed is None else int(seed)
+
 # takes in an input json schema and runs model inference, outputs in image in bytes
 def handler(job):
     job_input = job["input"]
 
     image = job_input['base_image']
-    edit_prompt = job_input['target_prompt']
     steps = int(job_input['ddim_steps'])
     resolution = 512
+
+    guidance_interval = float(job_input.get('guidance_interval', 0.))
+    image_guidance_every = int(job_input.get('image_guidance_every', 1))
+
+    if 'edits' in job_input:
+        return run_edits(image, resolution, steps, [parse_edit(edit) for edit in job_input['edits']],
+                         guidance_interval=guidance_interval, image_guidance_every=image_guidance_every)
+
+    edit_prompt = job_input['target_prompt']
     cfg_text = float(job_input['text_scale'])
     cfg_img = float(job_input['image_scale'])
     seed = job_input['seed']
@@ -162,7 +334,9 @@ def handler(job):
         steps = steps, 
         cfg_text = cfg_text,
         cfg_image = cfg_img,
-        seed = seed
+        seed = seed,
+        guidance_interval = guidance_interval,
+        image_guidance_every = image_guidance_every
     )
 
     return final_image_bytes
@@ -183,6 +183,16 @@ class DDPM(pl.LightningModule):
                 if context is not None:
                     print(f"{context}: Restored training weights")
 
+    def bake_ema(self, copy=True):
+        """Serving mode: load the EMA weights into the model once and drop the EMA buffers,
+        so ema_scope() no longer copies the whole UNet twice per call. Pass copy=False when
+        the checkpoint had no EMA weights, the buffers then only hold the initialization."""
+        if self.use_ema:
+            if copy:
+                self.model_ema.copy_to(self.model)
+            del self.model_ema
+            self.use_ema = False
+
     def init_from_ckpt(self, path, ignore_keys=list(), only_model=False):
         sd = torch.load(path, map_location="cpu")
         if "state_dict" in list(sd.keys()):
@@ -1,4 +1,4 @@
-import argparse, os, sys, glob
+import argparse, os, sys, glob, random
 import cv2
 import torch
 import numpy as np
@@ -14,15 +14,18 @@ from pytorch_lightning import seed_everything
 from torch import autocast
 from contextlib import contextmanager, nullcontext
 import torchvision
-from ldm.util import instantiate_from_config
+from ldm.util import instantiate_from_config, load_safetensors, safetensors_path
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.models.diffusion.plms import PLMSSampler
+from batching import DynamicBatcher, batch_guidance_scale, batch_noise
 from io import BytesIO
 from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
 from transformers import AutoFeatureExtractor
 from torchvision.transforms import Resize
 import runpod
 import base64
+import hashlib
+from collections import OrderedDict
 
 def get_safety():    
     wm = "Paint-by-Example"
@@ -33,7 +36,10 @@ def get_safety():
     safety_checker = StableDiffusionSafetyChecker.from_pretrained(safety_model_id)
     return wm, wm_encoder, safety_model_id, safety_feature_extractor, safety_checker
 
-wm, wm_encoder, safety_model_id, safety_feature_extractor, safety_checker = get_safety()
+# the CLIP safety model is only loaded when enabled for the endpoint, jobs opt in with outputs=[..., "nsfw"]
+ENABLE_SAFETY = os.getenv("PBE_ENABLE_SAFETY", "0") == "1"
+if ENABLE_SAFETY:
+    wm, wm_encoder, safety_model_id, safety_feature_extractor, safety_checker = get_safety()
 
 
 def chunk(it, size):
@@ -62,19 +68,27 @@ def numpy_to_pil(images):
     return pil_images
 
 def load_model_from_config(_config, ckpt, verbose=False):
-    print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
-    if "global_step" in pl_sd:
-        print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
     model = instantiate_from_config(_config.model)
-    m, u = model.load_state_dict(sd, strict=False)
+    if os.path.exists(safetensors_path(ckpt)):
+        # converted with models/convert_to_safetensors.py, streamed straight into the GPU copy
+        print(f"Loading model from {safetensors_path(ckpt)}")
+        model.cuda()
+        m, u = load_safetensors(model, safetensors_path(ckpt))
+    else:
+        print(f"Loading model from {ckpt}")
+        pl_sd = torch.load(ckpt, map_location="cpu")
+        if "global_step" in pl_sd:
+            print(f"Global Step: {pl_sd['global_step']}")
+        sd = pl_sd["state_dict"]
+        m, u = model.load_state_dict(sd, strict=False)
     if len(m) > 0 and verbose:
         print("missing keys:")
         print(m)
     if len(u) > 0 and verbose:
         print("unexpected keys:")
         print(u)
+    # serve with the EMA weights baked in, ema_scope() is a no-op afterwards
+    model.bake_ema(copy=not any(k.startswith("model_ema.") for k in m))
 
     model.cuda()
     model.eval()
@@ -141,73 +155,100 @@ def get_models ():
 
 config, model, sampler, device = get_models()
 
-def run_local(
+# sha1 of the 224x224 reference -> projected CLIP image embedding, users often reuse a reference
+reference_cache = OrderedDict()
+REFERENCE_CACHE_SIZE = int(os.getenv("PBE_REF_CACHE_SIZE", 64))
+
+def reference_embedding(ref_p, ref_tensor):
+    key = hashlib.sha1(ref_p.tobytes()).hexdigest()
+    if key in reference_cache:
+        reference_cache.move_to_end(key)
+        return reference_cache[key]
+
+    c = model.get_learned_conditioning(ref_tensor.to(torch.float16))
+    c = model.proj_out(c)
+
+    reference_cache[key] = c
+    while len(reference_cache) > REFERENCE_CACHE_SIZE:
+        reference_cache.popitem(last=False)
+    return c
+
+def prepare_local(
     input_image: Image.Image,
     mask_image: Image.Image,
     reference_image: Image.Image,
     ddim_steps: int = 50,
-    fixed_code: bool = False,
-    ddim_eta: float = 0.0,
-    n_samples: int = 1,
     scale: float = 5,
+    seed: int = -1,
+    outputs=("image",),
+):
+    # the per-job CPU work; jobs whose batch_key matches can share one sampler call
+    input_image = input_image.resize((512, 512))
+    mask_image = mask_image.resize((512, 512))
+
+    img_p = input_image.convert("RGB")
+    image_tensor = get_tensor()(img_p)
+    image_tensor = image_tensor.unsqueeze(0)
+    ref_p = reference_image.convert("RGB").resize((224,224))
+    ref_tensor=get_tensor_clip()(ref_p)
+    ref_tensor = ref_tensor.unsqueeze(0)
+    mask= mask_image.convert("L")
+    mask = np.array(mask)[None,None]
+    mask = 1 - mask.astype(np.float32)/255.0
+    mask[mask < 0.5] = 0
+    mask[mask >= 0.5] = 1
+    mask_tensor = torch.from_numpy(mask)
+    inpaint_image = image_tensor*mask_tensor
+    if seed is None or seed < 0:
+        seed = random.randint(0, 65535)
+    return dict(image_tensor=image_tensor, ref_p=ref_p, ref_tensor=ref_tensor, mask_tensor=mask_tensor,
+                inpaint_image=inpaint_image, ddim_steps=ddim_steps, scale=scale, seed=seed, outputs=outputs)
+
+def batch_key(item):
+    return (item["ddim_steps"],)
+
+def run_batch(
+    items,
+    ddim_eta: float = 0.0,
     precision: str = "autocast",
     C: int = 4,
     f: int = 8,
     W: int = 512,
     H: int = 512,
-    n_rows: int = 0
 ):
+    # items share a batch_key; references, images, masks, seeds and guidance scales are per sample
     global config, model, sampler, device 
 
-    input_image = input_image.resize((512, 512))
-    mask_image = mask_image.resize((512, 512))
-
-    batch_size = n_samples
-    n_rows = n_rows if n_rows > 0 else batch_size
-
-    start_code = None
-    if fixed_code:
-        start_code = torch.randn([n_samples, C, H // f, W // f], device=device)
+    n_samples = len(items)
+    shape = [C, H // f, W // f]
+    start_code = batch_noise([item["seed"] for item in items], shape, device=device)
 
     precision_scope = autocast if precision=="autocast" else nullcontext
     with torch.no_grad():
         with precision_scope("cuda"):
             with model.ema_scope():
-                img_p = input_image.convert("RGB")
-                image_tensor = get_tensor()(img_p)
-                image_tensor = image_tensor.unsqueeze(0)
-                ref_p = reference_image.convert("RGB").resize((224,224))
-                ref_tensor=get_tensor_clip()(ref_p)
-                ref_tensor = ref_tensor.unsqueeze(0)
-                mask= mask_image.convert("L")
-                mask = np.array(mask)[None,None]
-                mask = 1 - mask.astype(np.float32)/255.0
-                mask[mask < 0.5] = 0
-                mask[mask >= 0.5] = 1
-                mask_tensor = torch.from_numpy(mask)
-                inpaint_image = image_tensor*mask_tensor
+                image_tensor = torch.cat([item["image_tensor"] for item in items])
+                inpaint_image = torch.cat([item["inpaint_image"] for item in items])
+                ref_tensor = torch.cat([item["ref_tensor"] for item in items]).to(device)
                 test_model_kwargs={}
-                test_model_kwargs['inpaint_mask']=mask_tensor.to(device)
+                test_model_kwargs['inpaint_mask']=torch.cat([item["mask_tensor"] for item in items]).to(device)
                 test_model_kwargs['inpaint_image']=inpaint_image.to(device)
-                ref_tensor=ref_tensor.to(device)
+                scales = [item["scale"] for item in items]
                 uc = None
-                if scale != 1.0:
-                    uc = model.learnable_vector
-                c = model.get_learned_conditioning(ref_tensor.to(torch.float16))
-                c = model.proj_out(c)
-                inpaint_mask=test_model_kwargs['inpaint_mask']
+                if any(scale != 1.0 for scale in scales):
+                    uc = model.learnable_vector.repeat(n_samples, 1, 1)
+                c = torch.cat([reference_embedding(item["ref_p"], item["ref_tensor"].to(device)) for item in items])
                 z_inpaint = model.encode_first_stage(test_model_kwargs['inpaint_image'])
                 z_inpaint = model.get_first_stage_encoding(z_inpaint).detach()
                 test_model_kwargs['inpaint_image']=z_inpaint
                 test_model_kwargs['inpaint_mask']=Resize([z_inpaint.shape[-2],z_inpaint.shape[-1]])(test_model_kwargs['inpaint_mask'])
 
-                shape = [C, H // f, W // f]
-                samples_ddim, _ = sampler.sample(S=ddim_steps,
+                samples_ddim, _ = sampler.sample(S=items[0]["ddim_steps"],
                                                     conditioning=c,
                                                     batch_size=n_samples,
                                                     shape=shape,
                                                     verbose=False,
-                                                    unconditional_guidance_scale=scale,
+                                                    unconditional_guidance_scale=batch_guidance_scale(scales, device=device),
                                                     unconditional_conditioning=uc,
                                                     eta=ddim_eta,
                                                     x_T=start_code,
@@ -217,8 +258,14 @@ def run_local(
                 x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
                 x_samples_ddim = x_samples_ddim.cpu().permute(0, 2, 3, 1).numpy()
 
-                x_checked_image, has_nsfw_concept = check_safety(x_samples_ddim)
-                x_checked_image=x_samples_ddim
+                results = [{} for _ in items]
+                # as before, the checker only flags images, the returned images are never replaced
+                x_checked_image = x_samples_ddim
+                checked = [i for i, item in enumerate(items) if "nsfw" in item["outputs"]]
+                if checked:
+                    _, has_nsfw_concept = check_safety(x_samples_ddim[checked])
+                    for i, flag in zip(checked, has_nsfw_concept):
+                        results[i]["nsfw"] = bool(flag)
                 x_checked_image_torch = torch.from_numpy(x_checked_image).permute(0, 3, 1, 2)
 
                 def un_norm(x):
@@ -230,22 +277,39 @@ def run_local(
                     return x
 
                 for i,x_sample in enumerate(x_checked_image_torch):
-                    all_img=[]
-                    all_img.append(un_norm(image_tensor[i]).cpu())
-                    all_img.append(un_norm(inpaint_image[i]).cpu())
-                    ref_img=ref_tensor
-                    ref_img=Resize([H, W])(ref_img)
-                    all_img.append(un_norm_clip(ref_img[i]).cpu())
-                    all_img.append(x_sample)
-                    grid = torch.stack(all_img, 0)
-                    grid = make_grid(grid)
-                    grid = 255. * rearrange(grid, 'c h w -> h w c').cpu().numpy()
-                    grid_img = Image.fromarray(grid.astype(np.uint8))
+                    if "grid" in items[i]["outputs"]:
+                        all_img=[]
+                        all_img.append(un_norm(image_tensor[i]).cpu())
+                        all_img.append(un_norm(inpaint_image[i]).cpu())
+                        ref_img=ref_tensor
+                        ref_img=Resize([H, W])(ref_img)
+                        all_img.append(un_norm_clip(ref_img[i]).cpu())
+                        all_img.append(x_sample)
+                        grid = torch.stack(all_img, 0)
+                        grid = make_grid(grid)
+                        grid = 255. * rearrange(grid, 'c h w -> h w c').cpu().numpy()
+                        results[i]["grid"] = Image.fromarray(grid.astype(np.uint8))
 
                     x_sample = 255. * rearrange(x_sample.cpu().numpy(), 'c h w -> h w c')
-                    result_img = Image.fromarray(x_sample.astype(np.uint8))
-                    
-    return result_img, grid_img
+                    results[i]["image"] = Image.fromarray(x_sample.astype(np.uint8))
+
+    # per job: the image, plus its input/reference grid and safety flag when requested
+    return results
+
+def run_local(
+    input_image: Image.Image,
+    mask_image: Image.Image,
+    reference_image: Image.Image,
+    ddim_steps: int = 50,
+    scale: float = 5,
+    seed: int = -1,
+    outputs=("image",),
+):
+    item = prepare_local(input_image, mask_image, reference_image, ddim_steps=ddim_steps, scale=scale, seed=seed,
+                         outputs=outputs)
+    return run_batch([item])[0]
+
+batcher = DynamicBatcher(run_batch)
 
 def decode_base64_image(base64_string):
     img_data = base64.b64decode(base64_string)
@@ -256,7 +320,7 @@ def encode_pil_to_base64(pil_image):
     pil_image.save(buffered, format="PNG")
     return base64.b64encode(buffered.getvalue()).decode("utf-8")
 
-def handler(job):
+async def handler(job):
     job_input = job["input"]
 
     base_image = decode_base64_image(job_input["base_image"])
@@ -265,15 +329,30 @@ def handler(job):
     
     ddim_steps = job_input.get("ddim_steps", 50)
     scale = job_input.get("scale", 7.5)
-
-    result, _ = run_local(base_image, base_mask, ref_image, ddim_steps=ddim_steps, scale=scale)
-
-    result_b64 = encode_pil_to_base64(result)
-    
-    return {"image": result_b64}
+    outputs = job_input.get("outputs", ["image"])
+    unknown = set(outputs) - {"image", "grid", "nsfw"}
+    if unknown:
+        raise ValueError(f"Unknown outputs {sorted(unknown)}, expected any of 'image', 'grid' and 'nsfw'")
+    if "nsfw" in outputs and not ENABLE_SAFETY:
+        raise ValueError("The safety checker is disabled on this endpoint, set PBE_ENABLE_SAFETY=1")
+
+    item = prepare_local(base_image, base_mask, ref_image, ddim_steps=ddim_steps, scale=scale,
+                         seed=int(job_input.get("seed", -1)), outputs=outputs)
+    # jobs with the same step count arriving together share one sampler call
+    results = await batcher.submit(batch_key(item), item)
+
+    response = {}
+    if "image" in outputs:
+        response["image"] = encode_pil_to_base64(results["image"])
+    if "grid" in outputs:
+        response["grid"] = encode_pil_to_base64(results["grid"])
+    if "nsfw" in outputs:
+        # the flag only, flagged images are returned unchanged
+        response["nsfw"] = results["nsfw"]
+    return response
             
 if __name__ == "__main__":
-    runpod.serverless.start({"handler": handler})    
+    runpod.serverless.start({"handler": handler, "concurrency_modifier": batcher.concurrency_modifier})
 
     # img = Image.open("/home/azureuser/image-transcreation/Paint_by_Example/Paint-by-Example/examples/image/example_1.png")
     # print(np.array(img).shape) # (512, 512, 3)
@@ -284,12 +363,13 @@ if __name__ == "__main__":
     # reference = Image.open("/home/azureuser/image-transcreation/Paint_by_Example/Paint-by-Example/examples/reference/example_1.jpg")
     # print(np.array(reference).shape) # (1277, 1920, 3)
 
-    # result, grid = run_local(
+    # results = run_local(
     #     img, 
     #     mask,
-    #     reference
+    #     reference,
+    #     outputs=("image", "grid"),
     # )
-    # result.save("./result.png")
-    # grid.save("./grid.png")
+    # results["image"].save("./result.png")
+    # results["grid"].save("./grid.png")
 
     # run_st()
\ No newline at end of file
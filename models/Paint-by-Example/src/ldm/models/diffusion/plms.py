@@ -176,7 +176,9 @@ class PLMSSampler(object):
                       unconditional_guidance_scale=1., unconditional_conditioning=None, old_eps=None, t_next=None,**kwargs):
         b, *_, device = *x.shape, x.device
         def get_model_output(x, t):
-            if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
+            # a (b, 1, 1, 1) tensor scale gives each sample of the batch its own guidance
+            if unconditional_conditioning is None or (not torch.is_tensor(unconditional_guidance_scale)
+                                                       and unconditional_guidance_scale == 1.):
                 e_t = self.model.apply_model(x, t, c)
             else:
                 x_in = torch.cat([x] * 2)
@@ -1,5 +1,6 @@
 from inspect import isfunction
 import math
+import os
 import torch
 import torch.nn.functional as F
 from torch import nn, einsum
@@ -7,10 +8,19 @@ from einops import rearrange, repeat
 
 from ldm.modules.diffusionmodules.util import checkpoint
 
+SDPA_IS_AVAILABLE = hasattr(F, "scaled_dot_product_attention")
+ATTN_MODE = os.environ.get("ATTN_MODE")
+
 
 def exists(val):
     return val is not None
 
+def get_attn_mode():
+    """ATTN_MODE picks one of BasicTransformerBlock.ATTENTION_MODES, by default the fastest one installed."""
+    if ATTN_MODE is not None:
+        return ATTN_MODE
+    return "softmax-sdpa" if SDPA_IS_AVAILABLE else "softmax"
+
 
 def uniq(arr):
     return{el: True for el in arr}.keys()
@@ -193,13 +203,41 @@ class CrossAttention(nn.Module):
         return self.to_out(out)
 
 
+class SDPACrossAttention(CrossAttention):
+    """CrossAttention through torch's fused scaled_dot_product_attention, which never materializes
+    the (b*h, n, n) similarity matrix and accumulates in fp32 regardless of the input dtype."""
+    def forward(self, x, context=None, mask=None):
+        h = self.heads
+
+        q = self.to_q(x)
+        context = default(context, x)
+        k = self.to_k(context)
+        v = self.to_v(context)
+
+        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=h), (q, k, v))
+
+        if exists(mask):
+            mask = rearrange(mask, 'b ... -> b () () (...)')
+
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+        out = rearrange(out, 'b h n d -> b n (h d)')
+        return self.to_out(out)
+
+
 class BasicTransformerBlock(nn.Module):
+    ATTENTION_MODES = {
+        "softmax": CrossAttention,  # vanilla attention
+        "softmax-sdpa": SDPACrossAttention,
+    }
     def __init__(self, dim, n_heads, d_head, dropout=0., context_dim=None, gated_ff=True, checkpoint=True):
         super().__init__()
-        self.attn1 = CrossAttention(query_dim=dim, heads=n_heads, dim_head=d_head, dropout=dropout)  # is a self-attention
+        attn_mode = get_attn_mode()
+        assert attn_mode in self.ATTENTION_MODES
+        attn_cls = self.ATTENTION_MODES[attn_mode]
+        self.attn1 = attn_cls(query_dim=dim, heads=n_heads, dim_head=d_head, dropout=dropout)  # is a self-attention
         self.ff = FeedForward(dim, dropout=dropout, glu=gated_ff)
-        self.attn2 = CrossAttention(query_dim=dim, context_dim=context_dim,
-                                    heads=n_heads, dim_head=d_head, dropout=dropout)  # is self-attn if context is none
+        self.attn2 = attn_cls(query_dim=dim, context_dim=context_dim,
+                              heads=n_heads, dim_head=d_head, dropout=dropout)  # is self-attn if context is none
         self.norm1 = nn.LayerNorm(dim)
         self.norm2 = nn.LayerNorm(dim)
         self.norm3 = nn.LayerNorm(dim)
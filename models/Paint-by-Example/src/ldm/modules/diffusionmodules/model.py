@@ -6,7 +6,7 @@ import numpy as np
 from einops import rearrange
 
 from ldm.util import instantiate_from_config
-from ldm.modules.attention import LinearAttention
+from ldm.modules.attention import LinearAttention, get_attn_mode
 
 
 def get_timestep_embedding(timesteps, embedding_dim):
@@ -202,11 +202,36 @@ class AttnBlock(nn.Module):
         return x+h_
 
 
+class SDPAAttnBlock(AttnBlock):
+    """AttnBlock through torch's fused scaled_dot_product_attention (a single head over the
+    channels), without the (b, hw, hw) attention matrix. Same weights as AttnBlock."""
+    def forward(self, x):
+        h_ = x
+        h_ = self.norm(h_)
+        q = self.q(h_)
+        k = self.k(h_)
+        v = self.v(h_)
+
+        b,c,h,w = q.shape
+        q, k, v = map(lambda t: rearrange(t, 'b c h w -> b () (h w) c').contiguous(), (q, k, v))
+        h_ = torch.nn.functional.scaled_dot_product_attention(q, k, v)
+        h_ = rearrange(h_, 'b () (h w) c -> b c h w', h=h, w=w)
+
+        h_ = self.proj_out(h_)
+
+        return x+h_
+
+
 def make_attn(in_channels, attn_type="vanilla"):
-    assert attn_type in ["vanilla", "linear", "none"], f'attn_type {attn_type} unknown'
+    assert attn_type in ["vanilla", "vanilla-sdpa", "linear", "none"], f'attn_type {attn_type} unknown'
+    if attn_type == "vanilla" and get_attn_mode() == "softmax-sdpa":
+        # same backend as the UNet attention, see ldm.modules.attention.get_attn_mode
+        attn_type = "vanilla-sdpa"
     print(f"making attention of type '{attn_type}' with {in_channels} in_channels")
     if attn_type == "vanilla":
         return AttnBlock(in_channels)
+    elif attn_type == "vanilla-sdpa":
+        return SDPAAttnBlock(in_channels)
     elif attn_type == "none":
         return nn.Identity(in_channels)
     else:
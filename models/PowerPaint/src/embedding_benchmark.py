@@ -0,0 +1,113 @@
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from powerpaint.utils.utils import EmbeddingLayerWithFixes
+
+
+def replace_embeddings_loop(input_ids, embedding, external_embedding):
+    """Per-token splice of one row, as shipped before the vectorized version."""
+    new_embedding = []
+    start = external_embedding["start"]
+    end = external_embedding["end"]
+    target_ids_to_replace = list(range(start, end))
+    ext_emb = external_embedding["embedding"]
+
+    if not (input_ids == start).any():
+        return embedding
+
+    s_idx, e_idx = 0, 0
+    while e_idx < len(input_ids):
+        if input_ids[e_idx] == start:
+            if e_idx != 0:
+                new_embedding.append(embedding[s_idx:e_idx])
+            actually_ids_to_replace = [int(i) for i in input_ids[e_idx : e_idx + end - start]]
+            assert actually_ids_to_replace == target_ids_to_replace
+            new_embedding.append(ext_emb)
+            s_idx = e_idx + end - start
+            e_idx = s_idx + 1
+        else:
+            e_idx += 1
+
+    if e_idx == len(input_ids):
+        new_embedding.append(embedding[s_idx:e_idx])
+
+    return torch.cat(new_embedding, dim=0)
+
+
+def forward_loop(layer, input_ids):
+    inputs_embeds = layer.wrapped(layer.replace_input_ids(input_ids))
+    vecs = []
+    for input_id, embedding in zip(input_ids, inputs_embeds):
+        for external_embedding in layer.external_embeddings:
+            embedding = replace_embeddings_loop(input_id, embedding, external_embedding)
+        vecs.append(embedding)
+    return torch.stack(vecs)
+
+
+def make_layer(vocab_size, dim, num_tokens, num_vectors, device):
+    # the PowerPaint task tokens P_ctxt, P_shape, P_obj with 10 vectors each
+    layer = EmbeddingLayerWithFixes(nn.Embedding(vocab_size, dim))
+    layer.add_embeddings(
+        [
+            {
+                "name": f"P_{i}",
+                "embedding": torch.randn(num_vectors, dim),
+                "start": vocab_size + i * num_vectors,
+                "end": vocab_size + (i + 1) * num_vectors,
+            }
+            for i in range(num_tokens)
+        ]
+    )
+    return layer.to(device)
+
+
+def make_input_ids(layer, batch_size, length, generator):
+    """Padded CLIP-like rows with one or two task tokens spliced into the prompt."""
+    input_ids = torch.randint(1, layer.num_embeddings, (batch_size, length), generator=generator)
+    for row in range(batch_size):
+        num_found = 1 + row % 2
+        for k in range(num_found):
+            emb = layer.external_embeddings[(row + k) % len(layer.external_embeddings)]
+            col = 1 + k * (length // 2)
+            input_ids[row, col : col + emb["end"] - emb["start"]] = torch.arange(emb["start"], emb["end"])
+    return input_ids
+
+
+def timed(fn, *args, device=None, repeats=10):
+    fn(*args)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = fn(*args)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return out, (time.perf_counter() - start) / repeats
+
+
+@torch.no_grad()
+def main(args):
+    device = torch.device(args.device)
+    layer = make_layer(args.vocab_size, args.dim, 3, 10, device)
+    generator = torch.Generator().manual_seed(0)
+    for batch_size in args.batch_sizes:
+        input_ids = make_input_ids(layer, batch_size, 77, generator).to(device)
+        loop_out, loop_time = timed(forward_loop, layer, input_ids, device=device)
+        out, vec_time = timed(layer, input_ids, device=device)
+        assert torch.equal(out, loop_out), "vectorized splice does not match the per-token splice"
+        print(
+            f"batch {batch_size:3d} x 77 tokens on {device}: "
+            f"{loop_time * 1000:7.2f} ms -> {vec_time * 1000:7.2f} ms ({loop_time / vec_time:5.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-token and vectorized EmbeddingLayerWithFixes splicing")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--vocab_size", type=int, default=49408)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 6, 16, 64])
+    main(parser.parse_args())
@@ -1,4 +1,3 @@
-import argparse
 import os
 import random
 from io import BytesIO
@@ -37,6 +36,22 @@ def set_seed(seed):
     random.seed(seed)
 
 
+def mask_overlay(result, mask):
+    # the mask drawn in red over the result, both at the same size
+    mask_np = np.array(mask.convert("RGB"))
+    red = np.array(result).astype("float") * 1
+    red[:, :, 0] = 180.0
+    red[:, :, 2] = 0
+    red[:, :, 1] = 0
+    result_m = np.array(result)
+    return Image.fromarray(
+        (
+            result_m.astype("float") * (1 - mask_np.astype("float") / 512.0)
+            + mask_np.astype("float") / 512.0 * red
+        ).astype("uint8")
+    )
+
+
 def add_task(prompt, negative_prompt, control_type, version):
     pos_prefix = neg_prefix = ""
     if control_type == "object-removal" or control_type == "image-outpainting":
@@ -257,10 +272,15 @@ class PowerPaintController:
         task,
         vertical_expansion_ratio,
         horizontal_expansion_ratio,
+        keep_size=False,
+        outputs=None,
     ):
         size1, size2 = input_image["image"].convert("RGB").size
 
-        if task != "image-outpainting":
+        # keep_size: the caller already picked the working resolution (see predict_region)
+        if keep_size:
+            input_image["image"] = input_image["image"].convert("RGB")
+        elif task != "image-outpainting":
             if size1 < size2:
                 input_image["image"] = input_image["image"].convert("RGB").resize((640, int(size2 / size1 * 640)))
             else:
@@ -366,30 +386,99 @@ class PowerPaintController:
                 height=W,
             ).images[0]
 
-        mask_np = np.array(input_image["mask"].convert("RGB"))
-        red = np.array(result).astype("float") * 1
-        red[:, :, 0] = 180.0
-        red[:, :, 2] = 0
-        red[:, :, 1] = 0
-        result_m = np.array(result)
-        result_m = Image.fromarray(
-            (
-                result_m.astype("float") * (1 - mask_np.astype("float") / 512.0)
-                + mask_np.astype("float") / 512.0 * red
-            ).astype("uint8")
-        )
-        m_img = input_image["mask"].convert("RGB").filter(ImageFilter.GaussianBlur(radius=3))
-        m_img = np.asarray(m_img) / 255.0
-        img_np = np.asarray(input_image["image"].convert("RGB")) / 255.0
-        ours_np = np.asarray(result) / 255.0
-        ours_np = ours_np * m_img + (1 - m_img) * img_np
-        dict_res = [input_image["mask"].convert("RGB"), result_m]
+        # outputs=None keeps the gradio behaviour of always building the mask overlay
+        dict_res = []
+        if outputs is None or "overlay" in outputs:
+            dict_res = [input_image["mask"].convert("RGB"), mask_overlay(result, input_image["mask"])]
 
-        # result_paste = Image.fromarray(np.uint8(ours_np * 255))
-        # dict_out = [input_image["image"].convert("RGB"), result_paste]
         dict_out = [result]
         return dict_out, dict_res
 
+    def predict_region(
+        self,
+        input_image,
+        prompt,
+        fitting_degree,
+        ddim_steps,
+        scale,
+        seed,
+        negative_prompt,
+        task,
+        expand_ratio=1.5,
+        min_size=512,
+        max_size=1024,
+        feather=8,
+        outputs=None,
+    ):
+        # inpaint a padded square around the mask bbox at (close to) native resolution and
+        # feather-blend it back into the full-resolution image, instead of denoising the whole frame
+        image = input_image["image"].convert("RGB")
+        mask = np.array(input_image["mask"].convert("L").resize(image.size, Image.NEAREST)) > 127
+        H, W = mask.shape
+        if mask.any():
+            ys, xs = np.where(mask)
+            y1, y2, x1, x2 = ys.min(), ys.max() + 1, xs.min(), xs.max() + 1
+        if not mask.any() or max(y2 - y1, x2 - x1) > min(H, W):
+            # no square crop fits the mask, fall back to the full frame
+            return self.predict(
+                input_image,
+                prompt,
+                fitting_degree,
+                ddim_steps,
+                scale,
+                seed,
+                negative_prompt,
+                task,
+                None,
+                None,
+                outputs=outputs,
+            )
+
+        side = min(max(int(max(y2 - y1, x2 - x1) * expand_ratio), min_size), H, W)
+        top = int(np.clip((y1 + y2) // 2 - side // 2, 0, H - side))
+        left = int(np.clip((x1 + x2) // 2 - side // 2, 0, W - side))
+        box = (left, top, left + side, top + side)
+
+        # crops between min_size and max_size run at their native size
+        size = int(np.clip(side, min_size, max_size)) // 8 * 8
+        crop_mask = Image.fromarray(mask[top : top + side, left : left + side].astype(np.uint8) * 255)
+        crop = {
+            "image": image.crop(box).resize((size, size), Image.LANCZOS),
+            "mask": crop_mask.resize((size, size), Image.NEAREST).convert("RGB"),
+        }
+        # the overlay of the crop is not needed, it is rebuilt on the full frame below
+        dict_out, _ = self.predict(
+            crop,
+            prompt,
+            fitting_degree,
+            ddim_steps,
+            scale,
+            seed,
+            negative_prompt,
+            task,
+            None,
+            None,
+            keep_size=True,
+            outputs=["image"],
+        )
+
+        result = np.asarray(dict_out[0].convert("RGB").resize((side, side), Image.LANCZOS)) / 255.0
+        # grow the mask before blurring so the feathered edge stays outside the removed object
+        m_img = crop_mask.filter(ImageFilter.MaxFilter(2 * feather + 1))
+        m_img = m_img.filter(ImageFilter.GaussianBlur(radius=feather))
+        m_img = (np.asarray(m_img) / 255.0)[:, :, None]
+        out = np.array(image)
+        out[top : top + side, left : left + side] = np.uint8(
+            (result * m_img + (1 - m_img) * out[top : top + side, left : left + side] / 255.0) * 255
+        )
+        out = Image.fromarray(out)
+
+        dict_res = []
+        if outputs is None or "overlay" in outputs:
+            full_mask = Image.fromarray(mask.astype(np.uint8) * 255).convert("RGB")
+            dict_res = [full_mask, mask_overlay(out, full_mask)]
+        return [out], dict_res
+
     def predict_controlnet(
         self,
         input_image,
@@ -498,6 +587,8 @@ class PowerPaintController:
         input_control_image=None,
         control_type="canny",
         controlnet_conditioning_scale=None,
+        region=False,
+        outputs=None,
     ):
         if task == "text-guided":
             prompt = text_guided_prompt
@@ -522,6 +613,7 @@ class PowerPaintController:
                 task,
                 vertical_expansion_ratio,
                 horizontal_expansion_ratio,
+                outputs=outputs,
             )
         else:
             task = "text-guided"
@@ -541,9 +633,23 @@ class PowerPaintController:
                 negative_prompt,
                 controlnet_conditioning_scale,
             )
+        elif region:
+            return self.predict_region(
+                input_image, prompt, fitting_degree, ddim_steps, scale, seed, negative_prompt, task, outputs=outputs
+            )
         else:
             return self.predict(
-                input_image, prompt, fitting_degree, ddim_steps, scale, seed, negative_prompt, task, None, None
+                input_image,
+                prompt,
+                fitting_degree,
+                ddim_steps,
+                scale,
+                seed,
+                negative_prompt,
+                task,
+                None,
+                None,
+                outputs=outputs,
             )
 def base64_to_image(base64_string):
     image_data = base64.b64decode(base64_string)
@@ -554,22 +660,58 @@ def image_to_base64(image):
     image.save(buffered, format="PNG")
     return base64.b64encode(buffered.getvalue()).decode("utf-8")
 
-def handler(job):
+# worker config, fixed for the lifetime of the worker (set through the endpoint environment)
+WEIGHT_DTYPE = os.getenv("POWERPAINT_WEIGHT_DTYPE", "float16")
+CHECKPOINT_DIR = os.getenv("POWERPAINT_CHECKPOINT_DIR", "./checkpoints/ppt-v2")
+VERSION = os.getenv("POWERPAINT_VERSION", "ppt-v2")
+LOCAL_FILES_ONLY = os.getenv("POWERPAINT_LOCAL_FILES_ONLY", "1") == "1"
+PROMPT_CACHE_SIZE = int(os.getenv("POWERPAINT_PROMPT_CACHE_SIZE", "256"))
+
+weight_dtype = torch.float16 if WEIGHT_DTYPE == "float16" else torch.float32
+controller = None
+
+def controller_inputs(image, mask, prompt, negative_prompt, mode, ddim_steps, scale, seed):
+    return [
+        # input_image + Mask, predict() reads "image"/"mask" (the old "base_image"/"base_mask" keys raised a KeyError)
+        {"image": image, "mask": mask},
+        prompt if mode == 'text-guided' else "",  # text_guided_prompt
+        negative_prompt if mode == 'text-guided' else "",  # text_guided_negative_prompt
+        "",  # shape_guided_prompt (not used)
+        "",  # shape_guided_negative_prompt (not used)
+        1,  # fitting_degree (not used)
+        ddim_steps,
+        scale,
+        seed,
+        mode,
+        1,  # vertical_expansion_ratio (not used)
+        1,  # horizontal_expansion_ratio (not used)
+        "",  # outpaint_prompt (not used)
+        "",  # outpaint_negative_prompt (not used)
+        prompt if mode == 'object-removal' else "",  # removal_prompt
+        negative_prompt if mode == 'object-removal' else "",  # removal_negative_prompt
+    ]
 
-    inputs = job["input"]
+def warmup():
+    # one short job so kernel selection and allocator growth happen before the first request
+    image = Image.new("RGB", (512, 512), (127, 127, 127))
+    mask = Image.new("RGB", (512, 512), (0, 0, 0))
+    mask.paste((255, 255, 255), (128, 128, 384, 384))
+    # both modes, so their constant task prompts are already in the prompt cache
+    controller.infer(*controller_inputs(image, mask, "a vase", "", "text-guided", 2, 7.5, 0))
+    controller.infer(*controller_inputs(image, mask, "", "", "object-removal", 2, 7.5, 0))
 
-    args = argparse.ArgumentParser()
-    args.add_argument("--weight_dtype", type=str, default="float16")
-    args.add_argument("--checkpoint_dir", type=str, default="./checkpoints/ppt-v2")
-    args.add_argument("--version", type=str, default="ppt-v2")
-    args.add_argument(
-        "--local_files_only", default = True, action="store_true", help="enable it to use cached files without requesting from the hub"
-    )
-    args = args.parse_args()
+def initialize_model():
+    global controller
+    controller = PowerPaintController(weight_dtype, CHECKPOINT_DIR, LOCAL_FILES_ONLY, VERSION)
+    if hasattr(controller.pipe, "prompt_cache_size"):
+        controller.pipe.prompt_cache_size = PROMPT_CACHE_SIZE
+    warmup()
 
-    # initialize the pipeline controller
-    weight_dtype = torch.float16 if args.weight_dtype == "float16" else torch.float32
-    controller = PowerPaintController(weight_dtype, args.checkpoint_dir, args.local_files_only, args.version)
+initialize_model()
+
+def handler(job):
+
+    inputs = job["input"]
 
     # Validate inputs
     required_keys = ['base_image', 'base_mask', 'target_prompt', 'negative_prompt', 'mode', 'ddim_steps', 'text_scale', 'seed']
@@ -580,37 +722,31 @@ def handler(job):
     if inputs['mode'] not in ['object-removal', 'text-guided']:
         raise ValueError("Task must be either 'object-removal' or 'text-guided'")
 
-    # Combine input image and mask
-    input_images = {}
-    input_images["base_image"] = base64_to_image(inputs['base_image']).copy()
-    input_images["base_mask"] = base64_to_image(inputs['base_mask']).copy()
-
-    # Prepare inputs for the controller
-    controller_inputs = [
-        input_images,  # input_image + Mask
-        inputs['target_prompt'] if inputs['mode'] == 'text-guided' else "",  # text_guided_prompt
-        inputs['negative_prompt'] if inputs['mode'] == 'text-guided' else "",  # text_guided_negative_prompt
-        "",  # shape_guided_prompt (not used)
-        "",  # shape_guided_negative_prompt (not used)
-        1,  # fitting_degree (not used)
+    # "overlay" (the mask drawn in red over the result) is only computed when asked for
+    outputs = inputs.get('outputs', ['image'])
+    unknown = set(outputs) - {'image', 'overlay'}
+    if unknown:
+        raise ValueError(f"Unknown outputs {sorted(unknown)}, expected 'image' and/or 'overlay'")
+
+    # Run the inference, "region": true only denoises a square around the mask at native resolution
+    output_images, res_images = controller.infer(*controller_inputs(
+        base64_to_image(inputs['base_image']).copy(),
+        base64_to_image(inputs['base_mask']).copy(),
+        inputs['target_prompt'],
+        inputs['negative_prompt'],
+        inputs['mode'],
         inputs['ddim_steps'],
         inputs['text_scale'],
         inputs['seed'],
-        inputs['mode'],
-        1,  # vertical_expansion_ratio (not used)
-        1,  # horizontal_expansion_ratio (not used)
-        "",  # outpaint_prompt (not used)
-        "",  # outpaint_negative_prompt (not used)
-        inputs['target_prompt'] if inputs['mode'] == 'object-removal' else "",  # removal_prompt
-        inputs['negative_prompt'] if inputs['mode'] == 'object-removal' else "",  # removal_negative_prompt
-    ]
-
-    # Run the inference
-    output_images, _ = controller.infer(*controller_inputs)
-
-    output_img_base64 = image_to_base64(output_images[0])
-    # Return the first (and only) output image
-    return {"image" : output_img_base64}
+    ), region=bool(inputs.get('region', False)), outputs=outputs)
+
+    result = {}
+    if 'image' in outputs:
+        # the first (and only) output image
+        result["image"] = image_to_base64(output_images[0])
+    if 'overlay' in outputs:
+        result["overlay"] = image_to_base64(res_images[1])
+    return result
 
 if __name__ == "__main__":
     runpod.serverless.start({"handler": handler})
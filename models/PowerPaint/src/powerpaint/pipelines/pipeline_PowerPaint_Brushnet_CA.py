@@ -1,4 +1,5 @@
 import inspect
+from collections import OrderedDict
 from typing import Any, Callable, Dict, List, Optional, Union
 
 import numpy as np
@@ -223,6 +224,48 @@ class StableDiffusionPowerPaintBrushNetPipeline(
         self.vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)
         self.image_processor = VaeImageProcessor(vae_scale_factor=self.vae_scale_factor, do_convert_rgb=True)
         self.register_to_config(requires_safety_checker=requires_safety_checker)
+        # (encoder, clip_skip, lora_scale, token ids, attention mask) -> hidden states, see `_encode_input_ids`
+        self.prompt_cache = OrderedDict()
+        self.prompt_cache_size = 256
+
+    def clear_prompt_cache(self):
+        # call after changing text encoder weights in place (load_state_dict, LoRA fusing, ...)
+        self.prompt_cache.clear()
+
+    def _encode_input_ids(
+        self, text_encoder, input_ids, device, attention_mask=None, clip_skip=None, lora_scale=None
+    ):
+        r"""
+        Encodes the rows of `input_ids` with `text_encoder`, running all rows missing from `self.prompt_cache` in a
+        single forward. The cache is keyed by the token ids after the `TokenizerWrapper` expanded the task tokens, so
+        the constant task prompts (`P_ctxt`, `P_obj`, empty negatives) are only ever encoded once per worker.
+        """
+        keys = []
+        for i, ids in enumerate(input_ids.tolist()):
+            mask = None if attention_mask is None else tuple(attention_mask[i].tolist())
+            keys.append((id(text_encoder), clip_skip, lora_scale, tuple(ids), mask))
+
+        missing = list(dict.fromkeys(key for key in keys if key not in self.prompt_cache))
+        if missing:
+            rows = [keys.index(key) for key in missing]
+            ids = input_ids[rows].to(device)
+            mask = None if attention_mask is None else attention_mask[rows].to(device)
+            if clip_skip is None:
+                hidden_states = text_encoder(ids, attention_mask=mask)[0]
+            else:
+                hidden_states = text_encoder(ids, attention_mask=mask, output_hidden_states=True)
+                # same as `encode_prompt`: pick the layer and apply the final LayerNorm
+                hidden_states = hidden_states[-1][-(clip_skip + 1)]
+                hidden_states = text_encoder.text_model.final_layer_norm(hidden_states)
+            for key, hidden_state in zip(missing, hidden_states):
+                self.prompt_cache[key] = hidden_state.clone()
+
+        for key in keys:
+            self.prompt_cache.move_to_end(key)
+        embeds = torch.stack([self.prompt_cache[key] for key in keys]).to(device)
+        while len(self.prompt_cache) > self.prompt_cache_size:
+            self.prompt_cache.popitem(last=False)
+        return embeds
 
     # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.StableDiffusionPipeline._encode_prompt
     def _encode_prompt(
@@ -281,6 +324,13 @@ class StableDiffusionPowerPaintBrushNetPipeline(
         else:
             batch_size = prompt_embeds.shape[0]
 
+        use_attention_mask = (
+            hasattr(self.text_encoder_brushnet.config, "use_attention_mask")
+            and self.text_encoder_brushnet.config.use_attention_mask
+        )
+        # A, B, negative A and negative B all go through text_encoder_brushnet in one batch
+        input_ids, attention_masks = [], []
+
         if prompt_embeds is None:
             # textual inversion: procecss multi-vector tokens if necessary
             if isinstance(self, TextualInversionLoaderMixin):
@@ -315,45 +365,8 @@ class StableDiffusionPowerPaintBrushNetPipeline(
                     f" {self.tokenizer.model_max_length} tokens: {removed_text}"
                 )
 
-            if (
-                hasattr(self.text_encoder_brushnet.config, "use_attention_mask")
-                and self.text_encoder_brushnet.config.use_attention_mask
-            ):
-                attention_mask = text_inputsA.attention_mask.to(device)
-            else:
-                attention_mask = None
-
-            # print("text_input_idsA: ",text_input_idsA)
-            # print("text_input_idsB: ",text_input_idsB)
-            # print('t: ',t)
-
-            prompt_embedsA = self.text_encoder_brushnet(
-                text_input_idsA.to(device),
-                attention_mask=attention_mask,
-            )
-            prompt_embedsA = prompt_embedsA[0]
-
-            prompt_embedsB = self.text_encoder_brushnet(
-                text_input_idsB.to(device),
-                attention_mask=attention_mask,
-            )
-            prompt_embedsB = prompt_embedsB[0]
-            prompt_embeds = prompt_embedsA * (t) + (1 - t) * prompt_embedsB
-            # print("prompt_embeds: ",prompt_embeds)
-
-        if self.text_encoder_brushnet is not None:
-            prompt_embeds_dtype = self.text_encoder_brushnet.dtype
-        elif self.unet is not None:
-            prompt_embeds_dtype = self.unet.dtype
-        else:
-            prompt_embeds_dtype = prompt_embeds.dtype
-
-        prompt_embeds = prompt_embeds.to(dtype=prompt_embeds_dtype, device=device)
-
-        bs_embed, seq_len, _ = prompt_embeds.shape
-        # duplicate text embeddings for each generation per prompt, using mps friendly method
-        prompt_embeds = prompt_embeds.repeat(1, num_images_per_prompt, 1)
-        prompt_embeds = prompt_embeds.view(bs_embed * num_images_per_prompt, seq_len, -1)
+            input_ids += [text_input_idsA, text_input_idsB]
+            attention_masks += [text_inputsA.attention_mask, text_inputsB.attention_mask]
 
         # get unconditional embeddings for classifier free guidance
         if do_classifier_free_guidance and negative_prompt_embeds is None:
@@ -385,7 +398,7 @@ class StableDiffusionPowerPaintBrushNetPipeline(
                 uncond_tokensA = self.maybe_convert_prompt(uncond_tokensA, self.tokenizer)
                 uncond_tokensB = self.maybe_convert_prompt(uncond_tokensB, self.tokenizer)
 
-            max_length = prompt_embeds.shape[1]
+            max_length = self.tokenizer.model_max_length if prompt_embeds is None else prompt_embeds.shape[1]
             uncond_inputA = self.tokenizer(
                 uncond_tokensA,
                 padding="max_length",
@@ -401,25 +414,37 @@ class StableDiffusionPowerPaintBrushNetPipeline(
                 return_tensors="pt",
             )
 
-            if (
-                hasattr(self.text_encoder_brushnet.config, "use_attention_mask")
-                and self.text_encoder_brushnet.config.use_attention_mask
-            ):
-                attention_mask = uncond_inputA.attention_mask.to(device)
-            else:
-                attention_mask = None
+            input_ids += [uncond_inputA.input_ids, uncond_inputB.input_ids]
+            attention_masks += [uncond_inputA.attention_mask, uncond_inputB.attention_mask]
 
-            negative_prompt_embedsA = self.text_encoder_brushnet(
-                uncond_inputA.input_ids.to(device),
-                attention_mask=attention_mask,
-            )
-            negative_prompt_embedsB = self.text_encoder_brushnet(
-                uncond_inputB.input_ids.to(device),
-                attention_mask=attention_mask,
+        if input_ids:
+            embeds = self._encode_input_ids(
+                self.text_encoder_brushnet,
+                torch.cat(input_ids),
+                device,
+                attention_mask=torch.cat(attention_masks) if use_attention_mask else None,
             )
-            negative_prompt_embeds = negative_prompt_embedsA[0] * (t_nag) + (1 - t_nag) * negative_prompt_embedsB[0]
+            embeds = list(embeds.split([ids.shape[0] for ids in input_ids]))
+            if prompt_embeds is None:
+                prompt_embedsA, prompt_embedsB = embeds.pop(0), embeds.pop(0)
+                prompt_embeds = prompt_embedsA * (t) + (1 - t) * prompt_embedsB
+            if embeds:
+                negative_prompt_embedsA, negative_prompt_embedsB = embeds
+                negative_prompt_embeds = negative_prompt_embedsA * (t_nag) + (1 - t_nag) * negative_prompt_embedsB
+
+        if self.text_encoder_brushnet is not None:
+            prompt_embeds_dtype = self.text_encoder_brushnet.dtype
+        elif self.unet is not None:
+            prompt_embeds_dtype = self.unet.dtype
+        else:
+            prompt_embeds_dtype = prompt_embeds.dtype
+
+        prompt_embeds = prompt_embeds.to(dtype=prompt_embeds_dtype, device=device)
 
-            # negative_prompt_embeds = negative_prompt_embeds[0]
+        bs_embed, seq_len, _ = prompt_embeds.shape
+        # duplicate text embeddings for each generation per prompt, using mps friendly method
+        prompt_embeds = prompt_embeds.repeat(1, num_images_per_prompt, 1)
+        prompt_embeds = prompt_embeds.view(bs_embed * num_images_per_prompt, seq_len, -1)
 
         if do_classifier_free_guidance:
             # duplicate unconditional embeddings for each generation per prompt, using mps friendly method
@@ -499,14 +524,17 @@ class StableDiffusionPowerPaintBrushNetPipeline(
         else:
             batch_size = prompt_embeds.shape[0]
         # print('3 ',prompt,negative_prompt)
+        use_attention_mask = (
+            hasattr(self.text_encoder.config, "use_attention_mask") and self.text_encoder.config.use_attention_mask
+        )
+        # the prompt and the negative prompt go through text_encoder in one batch
+        input_ids, attention_masks = [], []
+
         if prompt_embeds is None:
             # textual inversion: process multi-vector tokens if necessary
-            # print('4 ',prompt,negative_prompt)
             if isinstance(self, TextualInversionLoaderMixin):
                 prompt = self.maybe_convert_prompt(prompt, self.tokenizer)
 
-            # print('5 ',prompt,negative_prompt)
-
             text_inputs = self.tokenizer(
                 prompt,
                 padding="max_length",
@@ -515,7 +543,6 @@ class StableDiffusionPowerPaintBrushNetPipeline(
                 return_tensors="pt",
             )
             text_input_ids = text_inputs.input_ids
-            # print(prompt, text_input_ids)
             untruncated_ids = self.tokenizer(prompt, padding="longest", return_tensors="pt").input_ids
 
             if untruncated_ids.shape[-1] >= text_input_ids.shape[-1] and not torch.equal(
@@ -529,41 +556,8 @@ class StableDiffusionPowerPaintBrushNetPipeline(
                     f" {self.tokenizer.model_max_length} tokens: {removed_text}"
                 )
 
-            if hasattr(self.text_encoder.config, "use_attention_mask") and self.text_encoder.config.use_attention_mask:
-                attention_mask = text_inputs.attention_mask.to(device)
-            else:
-                attention_mask = None
-
-            if clip_skip is None:
-                prompt_embeds = self.text_encoder(text_input_ids.to(device), attention_mask=attention_mask)
-                prompt_embeds = prompt_embeds[0]
-            else:
-                prompt_embeds = self.text_encoder(
-                    text_input_ids.to(device), attention_mask=attention_mask, output_hidden_states=True
-                )
-                # Access the `hidden_states` first, that contains a tuple of
-                # all the hidden states from the encoder layers. Then index into
-                # the tuple to access the hidden states from the desired layer.
-                prompt_embeds = prompt_embeds[-1][-(clip_skip + 1)]
-                # We also need to apply the final LayerNorm here to not mess with the
-                # representations. The `last_hidden_states` that we typically use for
-                # obtaining the final prompt representations passes through the LayerNorm
-                # layer.
-                prompt_embeds = self.text_encoder.text_model.final_layer_norm(prompt_embeds)
-
-        if self.text_encoder is not None:
-            prompt_embeds_dtype = self.text_encoder.dtype
-        elif self.unet is not None:
-            prompt_embeds_dtype = self.unet.dtype
-        else:
-            prompt_embeds_dtype = prompt_embeds.dtype
-
-        prompt_embeds = prompt_embeds.to(dtype=prompt_embeds_dtype, device=device)
-
-        bs_embed, seq_len, _ = prompt_embeds.shape
-        # duplicate text embeddings for each generation per prompt, using mps friendly method
-        prompt_embeds = prompt_embeds.repeat(1, num_images_per_prompt, 1)
-        prompt_embeds = prompt_embeds.view(bs_embed * num_images_per_prompt, seq_len, -1)
+            input_ids.append(text_input_ids)
+            attention_masks.append(text_inputs.attention_mask)
 
         # get unconditional embeddings for classifier free guidance
         if do_classifier_free_guidance and negative_prompt_embeds is None:
@@ -590,7 +584,7 @@ class StableDiffusionPowerPaintBrushNetPipeline(
             if isinstance(self, TextualInversionLoaderMixin):
                 uncond_tokens = self.maybe_convert_prompt(uncond_tokens, self.tokenizer)
 
-            max_length = prompt_embeds.shape[1]
+            max_length = self.tokenizer.model_max_length if prompt_embeds is None else prompt_embeds.shape[1]
             uncond_input = self.tokenizer(
                 uncond_tokens,
                 padding="max_length",
@@ -598,18 +592,55 @@ class StableDiffusionPowerPaintBrushNetPipeline(
                 truncation=True,
                 return_tensors="pt",
             )
-            # print("neg: ", uncond_input.input_ids)
 
-            if hasattr(self.text_encoder.config, "use_attention_mask") and self.text_encoder.config.use_attention_mask:
-                attention_mask = uncond_input.attention_mask.to(device)
-            else:
-                attention_mask = None
+            input_ids.append(uncond_input.input_ids)
+            attention_masks.append(uncond_input.attention_mask)
 
-            negative_prompt_embeds = self.text_encoder(
-                uncond_input.input_ids.to(device),
-                attention_mask=attention_mask,
+        if input_ids and clip_skip is None:
+            embeds = self._encode_input_ids(
+                self.text_encoder,
+                torch.cat(input_ids),
+                device,
+                attention_mask=torch.cat(attention_masks) if use_attention_mask else None,
+                lora_scale=lora_scale,
             )
-            negative_prompt_embeds = negative_prompt_embeds[0]
+            embeds = list(embeds.split([ids.shape[0] for ids in input_ids]))
+            if prompt_embeds is None:
+                prompt_embeds = embeds.pop(0)
+            if embeds:
+                negative_prompt_embeds = embeds.pop(0)
+        elif input_ids:
+            # as in diffusers, clip_skip only applies to the prompt, so the two need separate forwards
+            skips = ([clip_skip] if prompt_embeds is None else []) + [None]
+            embeds = [
+                self._encode_input_ids(
+                    self.text_encoder,
+                    ids,
+                    device,
+                    attention_mask=mask if use_attention_mask else None,
+                    clip_skip=skip,
+                    lora_scale=lora_scale,
+                )
+                for ids, mask, skip in zip(input_ids, attention_masks, skips)
+            ]
+            if prompt_embeds is None:
+                prompt_embeds = embeds.pop(0)
+            if embeds:
+                negative_prompt_embeds = embeds.pop(0)
+
+        if self.text_encoder is not None:
+            prompt_embeds_dtype = self.text_encoder.dtype
+        elif self.unet is not None:
+            prompt_embeds_dtype = self.unet.dtype
+        else:
+            prompt_embeds_dtype = prompt_embeds.dtype
+
+        prompt_embeds = prompt_embeds.to(dtype=prompt_embeds_dtype, device=device)
+
+        bs_embed, seq_len, _ = prompt_embeds.shape
+        # duplicate text embeddings for each generation per prompt, using mps friendly method
+        prompt_embeds = prompt_embeds.repeat(1, num_images_per_prompt, 1)
+        prompt_embeds = prompt_embeds.view(bs_embed * num_images_per_prompt, seq_len, -1)
 
         if do_classifier_free_guidance:
             # duplicate unconditional embeddings for each generation per prompt, using mps friendly method
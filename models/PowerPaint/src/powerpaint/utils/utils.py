@@ -391,58 +391,50 @@ class EmbeddingLayerWithFixes(nn.Module):
     def replace_embeddings(
         self, input_ids: torch.Tensor, embedding: torch.Tensor, external_embedding: dict
     ) -> torch.Tensor:
-        """Replace external embedding to the embedding layer. Noted that, in
-        this function we use `torch.cat` to avoid inplace modification.
+        """Replace external embedding to the embedding layer. Every position
+        holding the start id must be followed by the full id range of the
+        external embedding. The splice is done for the whole batch at once
+        with an out-of-place `index_put`, so trainable external embeddings
+        still receive gradients.
 
         Args:
             input_ids (torch.Tensor): The original token ids. Shape like
-                [LENGTH, ].
+                [bz, LENGTH].
             embedding (torch.Tensor): The embedding of token ids after
-                `replace_input_ids` function.
+                `replace_input_ids` function. Shape like [bz, LENGTH, dim].
             external_embedding (dict): The external embedding to be replaced.
 
         Returns:
             torch.Tensor: The replaced embedding.
         """
-        new_embedding = []
-
         name = external_embedding["name"]
         start = external_embedding["start"]
         end = external_embedding["end"]
-        target_ids_to_replace = list(range(start, end))
         ext_emb = external_embedding["embedding"]
 
+        # (row, column) of every placeholder start, i.e. [num_found, 2]
+        found = (input_ids == start).nonzero()
         # do not need to replace
-        if not (input_ids == start).any():
+        if found.shape[0] == 0:
             return embedding
 
-        # start replace
-        s_idx, e_idx = 0, 0
-        while e_idx < len(input_ids):
-            if input_ids[e_idx] == start:
-                if e_idx != 0:
-                    # add embedding do not need to replace
-                    new_embedding.append(embedding[s_idx:e_idx])
-
-                # check if the next embedding need to replace is valid
-                actually_ids_to_replace = [int(i) for i in input_ids[e_idx : e_idx + end - start]]
-                assert actually_ids_to_replace == target_ids_to_replace, (
-                    f"Invalid 'input_ids' in position: {s_idx} to {e_idx}. "
-                    f"Expect '{target_ids_to_replace}' for embedding "
-                    f"'{name}' but found '{actually_ids_to_replace}'."
-                )
-
-                new_embedding.append(ext_emb)
-
-                s_idx = e_idx + end - start
-                e_idx = s_idx + 1
-            else:
-                e_idx += 1
-
-        if e_idx == len(input_ids):
-            new_embedding.append(embedding[s_idx:e_idx])
+        # check that each start is followed by the complete id range
+        offsets = torch.arange(end - start, device=input_ids.device)
+        rows = found[:, :1].expand(-1, end - start)
+        cols = found[:, 1:] + offsets
+        in_range = cols < input_ids.shape[1]
+        valid = in_range & (input_ids[rows, cols.clamp(max=input_ids.shape[1] - 1)] == start + offsets)
+        if not valid.all():
+            row, col = found[(~valid).any(dim=1).nonzero()[0, 0]].tolist()
+            actually_ids_to_replace = input_ids[row, col : col + end - start].tolist()
+            raise AssertionError(
+                f"Invalid 'input_ids' in position: {col} to {col + end - start} of row {row}. "
+                f"Expect '{list(range(start, end))}' for embedding "
+                f"'{name}' but found '{actually_ids_to_replace}'."
+            )
 
-        return torch.cat(new_embedding, dim=0)
+        values = ext_emb.to(embedding.dtype).unsqueeze(0).expand(found.shape[0], -1, -1)
+        return embedding.index_put((rows.reshape(-1), cols.reshape(-1)), values.reshape(-1, embedding.shape[-1]))
 
     def forward(self, input_ids: torch.Tensor, external_embeddings: Optional[List[dict]] = None):
         """The forward function.
@@ -466,21 +458,16 @@ class EmbeddingLayerWithFixes(nn.Module):
         input_ids_fwd = self.replace_input_ids(input_ids)
         inputs_embeds = self.wrapped(input_ids_fwd)
 
-        vecs = []
-
         if external_embeddings is None:
             external_embeddings = []
         elif isinstance(external_embeddings, dict):
             external_embeddings = [external_embeddings]
         embeddings = self.external_embeddings + external_embeddings
 
-        for input_id, embedding in zip(input_ids, inputs_embeds):
-            new_embedding = embedding
-            for external_embedding in embeddings:
-                new_embedding = self.replace_embeddings(input_id, new_embedding, external_embedding)
-            vecs.append(new_embedding)
+        for external_embedding in embeddings:
+            inputs_embeds = self.replace_embeddings(input_ids, inputs_embeds, external_embedding)
 
-        return torch.stack(vecs)
+        return inputs_embeds
 
 
 def add_tokens(
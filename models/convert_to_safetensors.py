@@ -0,0 +1,76 @@
+"""Convert pickled checkpoints (.ckpt/.pth/.pt) to safetensors for faster worker cold starts.
+
+The handlers look for a .safetensors file next to the checkpoint they were configured with
+(same name, different extension) and stream it into the model from a memory map, falling back
+to torch.load when it is missing. Run after the get_ckpts_*.py scripts, e.g.
+
+    python convert_to_safetensors.py ControlNet/src/models/control_sd15_canny.pth
+    python convert_to_safetensors.py InstructPix2Pix/src/checkpoints/instruct-pix2pix-00-22000.ckpt --bake-ema --fp16
+"""
+import argparse
+import os
+
+import torch
+from safetensors.torch import save_file
+
+
+def get_state_dict(checkpoint):
+    # lightning checkpoints keep the weights under "state_dict", SAM2 under "model"
+    for key in ("state_dict", "model"):
+        if isinstance(checkpoint, dict) and isinstance(checkpoint.get(key), dict):
+            return checkpoint[key]
+    return checkpoint
+
+
+def bake_ema(state_dict):
+    """Replace the "model." weights by their LitEma shadows and drop the "model_ema." buffers."""
+    baked = 0
+    for key in list(state_dict):
+        if key.startswith("model."):
+            # LitEma stores "model.a.b.c" as "model_ema.abc"
+            ema_key = "model_ema." + key[len("model."):].replace(".", "")
+            if ema_key in state_dict:
+                state_dict[key] = state_dict[ema_key]
+                baked += 1
+    for key in [key for key in state_dict if key.startswith("model_ema.")]:
+        del state_dict[key]
+    return baked
+
+
+def convert(input_path, output_path, fp16=False, ema=False):
+    state_dict = dict(get_state_dict(torch.load(input_path, map_location="cpu")))
+    state_dict = {k: v for k, v in state_dict.items() if isinstance(v, torch.Tensor)}
+    if ema:
+        print(f"Baked {bake_ema(state_dict)} EMA weights")
+
+    tensors, seen = {}, set()
+    for key, tensor in state_dict.items():
+        if fp16 and tensor.is_floating_point():
+            tensor = tensor.half()
+        tensor = tensor.contiguous()
+        # safetensors refuses tensors sharing storage (tied weights, baked EMA)
+        storage = tensor.untyped_storage() if hasattr(tensor, "untyped_storage") else tensor.storage()
+        if storage.data_ptr() in seen:
+            tensor = tensor.clone()
+        else:
+            seen.add(storage.data_ptr())
+        tensors[key] = tensor
+
+    save_file(tensors, output_path)
+    size = os.path.getsize(output_path) / 2 ** 30
+    print(f"Wrote {len(tensors)} tensors ({size:.2f} GiB) to {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a pickled checkpoint to safetensors next to it")
+    parser.add_argument("input", type=str)
+    parser.add_argument("--output", type=str, default=None,
+                        help="defaults to the input path with a .safetensors extension, where the handlers look")
+    parser.add_argument("--fp16", action="store_true", help="store floating point tensors as fp16")
+    parser.add_argument("--bake-ema", action="store_true",
+                        help="resolve LitEma weights into the model and drop them (IP2P, Paint-by-Example)")
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.input)[0] + ".safetensors"
+    assert os.path.abspath(output) != os.path.abspath(args.input), "output would overwrite the input"
+    convert(args.input, output, fp16=args.fp16, ema=args.bake_ema)
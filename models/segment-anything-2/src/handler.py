@@ -4,6 +4,8 @@ import matplotlib.pyplot as plt
 from PIL import Image
 from sam2.build_sam import build_sam2
 from sam2.sam2_image_predictor import SAM2ImagePredictor
+from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
+from sam2.utils.amg import mask_to_rle_pytorch
 from io import BytesIO
 import requests
 import base64
@@ -11,6 +13,20 @@ import os
 import io
 import runpod
 import cv2
+import hashlib
+import zlib
+from collections import OrderedDict
+
+device = None
+sam2_model = None
+predictor = None
+mask_generator = None
+model_ready = False
+
+# image_id -> {"features", "orig_hw", "orig_size", "nbytes"}, oldest first
+embedding_cache = OrderedDict()
+embedding_cache_bytes = 0
+EMBEDDING_CACHE_BUDGET = int(os.getenv("SAM2_EMBEDDING_CACHE_BYTES", 512 * 1024 * 1024))
 
 def init_device():
     global device
@@ -20,19 +36,172 @@ def init_device():
         device = torch.device("mps")
     else:
         device = torch.device("cpu")
-        return device
+    return device
 
 def load_models():
     global sam2_model
     global predictor
+    global mask_generator
     sam2_checkpoint = "/"+os.path.abspath("checkpoints/sam2_hiera_large.pt")
     model_cfg = "/"+os.path.abspath("sam2_configs/sam2_hiera_l.yaml")
 
     sam2_model = build_sam2(model_cfg, sam2_checkpoint, device=device)
 
     predictor = SAM2ImagePredictor(sam2_model)
+    mask_generator = SAM2AutomaticMaskGenerator(sam2_model, output_mode="uncompressed_rle")
     return sam2_model, predictor
 
+def warmup():
+    # one encoder + decoder pass so the first real job doesn't pay for kernel selection / allocator growth
+    dummy = Image.new("RGB", (512, 512))
+    predictor.set_image(dummy)
+    predictor.predict(
+        point_coords=np.array([[256, 256]]),
+        point_labels=np.array([1]),
+        multimask_output=False,
+    )
+    predictor.reset_predictor()
+
+def initialize_model():
+    global model_ready
+    model_ready = False
+    init_device()
+    load_models()
+    warmup()
+    model_ready = True
+
+def image_hash(image: Image.Image) -> str:
+    digest = hashlib.sha1()
+    digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+def features_nbytes(features) -> int:
+    tensors = [features["image_embed"]] + list(features["high_res_feats"])
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+def cache_embedding(image_id, features, orig_hw, orig_size):
+    # returns the entry even when it is too large to keep, so callers can still use it for this job
+    global embedding_cache_bytes
+    if image_id in embedding_cache:
+        embedding_cache.move_to_end(image_id)
+        return embedding_cache[image_id]
+
+    nbytes = features_nbytes(features)
+    entry = {
+        "features": features,
+        "orig_hw": orig_hw,
+        "orig_size": orig_size,
+        "nbytes": nbytes,
+    }
+    if nbytes > EMBEDDING_CACHE_BUDGET:
+        return entry
+
+    while embedding_cache and embedding_cache_bytes + nbytes > EMBEDDING_CACHE_BUDGET:
+        _, evicted = embedding_cache.popitem(last=False)
+        embedding_cache_bytes -= evicted["nbytes"]
+
+    embedding_cache[image_id] = entry
+    embedding_cache_bytes += nbytes
+    return entry
+
+def lookup_embedding(image_id):
+    entry = embedding_cache.get(image_id)
+    if entry is not None:
+        embedding_cache.move_to_end(image_id)
+    return entry
+
+def restore_embedding(entry):
+    predictor.reset_predictor()
+    predictor._features = entry["features"]
+    predictor._orig_hw = entry["orig_hw"]
+    predictor._is_image_set = True
+
+def restore_embedding_batch(entries):
+    predictor.reset_predictor()
+    high_res_levels = zip(*[entry["features"]["high_res_feats"] for entry in entries])
+    predictor._features = {
+        "image_embed": torch.cat([entry["features"]["image_embed"] for entry in entries]),
+        "high_res_feats": [torch.cat(level) for level in high_res_levels],
+    }
+    predictor._orig_hw = [entry["orig_hw"][0] for entry in entries]
+    predictor._is_image_set = True
+    predictor._is_batch = True
+
+def set_image_cached(input):
+    # embeds input["image"] (or reuses the embedding for input["image_id"]), returns (image_id, orig_size)
+    # orig_size is None when only an unknown image_id was sent
+    if "image" not in input:
+        image_id = input["image_id"]
+        entry = lookup_embedding(image_id)
+        if entry is None:
+            return image_id, None
+        restore_embedding(entry)
+        return image_id, entry["orig_size"]
+
+    image = load_image(input["image"])
+    image_id = image_hash(image)
+    entry = lookup_embedding(image_id)
+    if entry is not None:
+        restore_embedding(entry)
+        return image_id, entry["orig_size"]
+
+    predictor.set_image(image.resize((512, 512)))
+    cache_embedding(image_id, predictor._features, predictor._orig_hw, image.size)
+    return image_id, image.size
+
+def set_image_batch_cached(items):
+    # batched version of set_image_cached: every image that is not cached yet goes through a single
+    # backbone forward, returns a list of (image_id, orig_size) in the order of items
+    entries = []
+    to_embed = []
+    for item in items:
+        if "image" in item:
+            image = load_image(item["image"])
+            image_id = image_hash(image)
+        else:
+            image, image_id = None, item["image_id"]
+
+        entry = lookup_embedding(image_id)
+        if entry is None and image is not None:
+            to_embed.append((len(entries), image_id, image))
+        entries.append([image_id, entry])
+
+    if to_embed:
+        predictor.set_image_batch([np.asarray(image.resize((512, 512))) for _, _, image in to_embed])
+        features = predictor._features
+        for j, (i, image_id, image) in enumerate(to_embed):
+            image_features = {
+                "image_embed": features["image_embed"][j : j + 1].clone(),
+                "high_res_feats": [feat[j : j + 1].clone() for feat in features["high_res_feats"]],
+            }
+            entries[i][1] = cache_embedding(image_id, image_features, predictor._orig_hw[j : j + 1], image.size)
+
+    if all(entry is not None for _, entry in entries):
+        restore_embedding_batch([entry for _, entry in entries])
+
+    return [(image_id, entry["orig_size"] if entry is not None else None) for image_id, entry in entries]
+
+def encode_logits(logits: np.ndarray) -> str:
+    # low-res logits are clamped to [-32, 32] by the predictor, so int8 keeps plenty of precision
+    quantized = np.round(np.clip(logits, -32.0, 32.0) * (127 / 32.0)).astype(np.int8)
+    return base64.b64encode(zlib.compress(quantized.tobytes())).decode('utf-8')
+
+def decode_logits(logits_b64: str) -> np.ndarray:
+    quantized = np.frombuffer(zlib.decompress(base64.b64decode(logits_b64)), dtype=np.int8)
+    return quantized.reshape(1, 256, 256).astype(np.float32) * (32.0 / 127)
+
+def pad_prompt_sets(prompts):
+    # stacks prompt sets with different point counts, padding with SAM's "not a point" label (-1)
+    num_points = max(len(prompt["points"]) for prompt in prompts)
+    coords = np.zeros((len(prompts), num_points, 2), dtype=np.float32)
+    labels = np.full((len(prompts), num_points), -1, dtype=np.int32)
+    for i, prompt in enumerate(prompts):
+        n = len(prompt["points"])
+        coords[i, :n] = prompt["points"]
+        labels[i, :n] = prompt["labels"]
+    return coords, labels
+
 def load_image_from_base64(base64_str: str) -> Image.Image:
     image_bytes = base64.b64decode(base64_str)
     image = Image.open(BytesIO(image_bytes)).convert("RGB")
@@ -69,6 +238,18 @@ def pil_image_to_base64(image: Image.Image) -> str:
     img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
     return img_str
 
+def encode_mask(mask, R, G, B, A, size, mask_format="png"):
+    # "png": base64 RGBA PNG (legacy), "rle": uncompressed COCO RLE {"size": [h, w], "counts": [...]}
+    if mask_format == "png":
+        return pil_image_to_base64(create_colored_mask_image(mask=mask, R=R, G=G, B=B, A=A).resize(size))
+
+    if mask.ndim > 2:
+        mask = mask[0]
+    mask = (mask > 0).astype(np.uint8)
+    if mask.shape[::-1] != tuple(size):
+        mask = cv2.resize(mask, tuple(size), interpolation=cv2.INTER_NEAREST)
+    return mask_to_rle_pytorch(torch.from_numpy(mask.astype(bool))[None])[0]
+
 def mask_to_pillow(image, mask, borders=True):
     color = np.array([30/255, 144/255, 255/255, 0.6])
     
@@ -96,38 +277,107 @@ def mask_to_pillow(image, mask, borders=True):
     
     return pil_image
 
+def batch_handler(input):
+    # input["images"]: [{"image" or "image_id", "prompts": [{"points", "labels"}, ...]}, ...]
+    items = input["images"]
+    R, G, B, A = input["R"], input["G"], input["B"], input["A"]
+    mask_format = input.get("mask_format", "png")
+
+    embedded = set_image_batch_cached(items)
+    missing = [image_id for image_id, orig_size in embedded if orig_size is None]
+    if missing:
+        return {"cache_miss": True, "missing": missing}
+
+    prompt_batch = [pad_prompt_sets(item["prompts"]) for item in items]
+    masks_batch, _, logits_batch = predictor.predict_batch(
+        point_coords_batch=[coords for coords, _ in prompt_batch],
+        point_labels_batch=[labels for _, labels in prompt_batch],
+        multimask_output=False,
+    )
+
+    results = []
+    for item, (image_id, orig_size), masks, logits in zip(items, embedded, masks_batch, logits_batch):
+        # predict_batch squeezes the prompt dim away when an image has a single prompt set
+        masks = masks.reshape(len(item["prompts"]), -1, *masks.shape[-2:])
+        logits = logits.reshape(len(item["prompts"]), -1, *logits.shape[-2:])
+        results.append({
+            "image_id": image_id,
+            "masks": [encode_mask(mask, R, G, B, A, orig_size, mask_format) for mask in masks],
+            "logits": [encode_logits(prompt_logits[:1]) for prompt_logits in logits],
+        })
+
+    return {"results": results}
+
+def everything_handler(input):
+    # every candidate mask of the image up front, so the canvas can resolve clicks locally
+    image = load_image(input["image"])
+    image_id = image_hash(image)
+    # shares the embedding cache with clicks: a cached image skips the full-frame encoder pass, and a
+    # new one leaves its full-frame features behind for the clicks that follow
+    entry = lookup_embedding(image_id)
+    anns = mask_generator.generate(np.asarray(image.resize((512, 512))),
+                                   image_features=entry["features"] if entry is not None else None)
+    if entry is None:
+        cache_embedding(image_id, mask_generator.image_features, [(512, 512)], image.size)
+
+    # smallest first, a click then resolves to the tightest mask that contains it
+    anns = sorted(anns, key=lambda ann: ann["area"])
+
+    return {
+        "image_id": image_id,
+        "size": [512, 512],
+        "masks": [ann["segmentation"] for ann in anns],
+        "bboxes": [ann["bbox"] for ann in anns],
+        "areas": [ann["area"] for ann in anns],
+        "scores": [ann["predicted_iou"] for ann in anns],
+    }
+
 def handler(job):
-    
-    device = init_device()
-    sam2_model, predictor = load_models()
+
+    if not model_ready:
+        initialize_model()
 
     input = job["input"]
-    image_b64 = input["image"]
-    image = load_image(image_b64)
+
+    if input.get("ping"):
+        return {"ready": model_ready}
+
+    if "images" in input:
+        return batch_handler(input)
+
+    if input.get("mode") == "everything":
+        return everything_handler(input)
+
+    image_id, orig_size = set_image_cached(input)
+    if orig_size is None:
+        # this worker has never seen (or already evicted) the image, the client has to resend it
+        return {"image_id": image_id, "cache_miss": True}
+
     R = input["R"]
     G = input["G"]
     B = input["B"]
     A = input["A"]
 
-    orig_width, orig_height = image.size
-
-    image = image.resize((512, 512))
+    orig_width, orig_height = orig_size
 
     points = np.array(input["points"])
     labels = np.array(input["labels"])
 
-    predictor.set_image(image)
+    # logits from the previous click, lets the decoder refine that mask instead of starting over
+    mask_input = decode_logits(input["mask_input"]) if input.get("mask_input") else None
 
-    masks, confidence, _ = predictor.predict(
+    masks, confidence, low_res_logits = predictor.predict(
         point_coords=points,
         point_labels=labels,
+        mask_input=mask_input,
         multimask_output=False,
     )
 
-    mask = create_colored_mask_image(mask = masks, R = R, G = G, B = B, A = A).resize((orig_width, orig_height))
-    mask_b64 = pil_image_to_base64(mask)
+    mask = encode_mask(masks, R, G, B, A, (orig_width, orig_height), input.get("mask_format", "png"))
     
-    return {"mask" : mask_b64}
+    return {"mask" : mask, "image_id" : image_id, "logits" : encode_logits(low_res_logits)}
+
+initialize_model()
 
 if __name__ == "__main__":
     runpod.serverless.start({"handler": handler})
\ No newline at end of file
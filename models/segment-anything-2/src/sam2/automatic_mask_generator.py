@@ -21,11 +21,13 @@ from sam2.utils.amg import (
     build_all_layer_point_grids,
     calculate_stability_score,
     coco_encode_rle,
+    connected_components_available,
     generate_crop_boxes,
     is_box_near_crop_edge,
     mask_to_rle_pytorch,
     MaskData,
     remove_small_regions,
+    remove_small_regions_batched,
     rle_to_mask,
     uncrop_boxes_xyxy,
     uncrop_masks,
@@ -38,7 +40,7 @@ class SAM2AutomaticMaskGenerator:
         self,
         model: SAM2Base,
         points_per_side: Optional[int] = 32,
-        points_per_batch: int = 64,
+        points_per_batch: Optional[int] = 64,
         pred_iou_thresh: float = 0.8,
         stability_score_thresh: float = 0.95,
         stability_score_offset: float = 1.0,
@@ -53,6 +55,7 @@ class SAM2AutomaticMaskGenerator:
         output_mode: str = "binary_mask",
         use_m2m: bool = False,
         multimask_output: bool = True,
+        crop_batch_size: int = 4,
         **kwargs,
     ) -> None:
         """
@@ -67,8 +70,9 @@ class SAM2AutomaticMaskGenerator:
             along one side of the image. The total number of points is
             points_per_side**2. If None, 'point_grids' must provide explicit
             point sampling.
-          points_per_batch (int): Sets the number of points run simultaneously
+          points_per_batch (int or None): Sets the number of points run simultaneously
             by the model. Higher numbers may be faster but use more GPU memory.
+            If None, it is picked per crop from the free GPU memory.
           pred_iou_thresh (float): A filtering threshold in [0,1], using the
             model's predicted mask quality.
           stability_score_thresh (float): A filtering threshold in [0,1], using
@@ -101,6 +105,8 @@ class SAM2AutomaticMaskGenerator:
             memory.
           use_m2m (bool): Whether to add a one step refinement using previous mask predictions.
           multimask_output (bool): Whether to output multimask at each point of the grid.
+          crop_batch_size (int): The number of crops of the same layer that are
+            run through the image encoder together.
         """
 
         assert (points_per_side is None) != (
@@ -148,6 +154,9 @@ class SAM2AutomaticMaskGenerator:
         self.output_mode = output_mode
         self.use_m2m = use_m2m
         self.multimask_output = multimask_output
+        self.crop_batch_size = crop_batch_size
+        # predictor features of the full image from the last generate() call
+        self.image_features = None
 
     @classmethod
     def from_pretrained(cls, model_id: str, **kwargs) -> "SAM2AutomaticMaskGenerator":
@@ -167,12 +176,20 @@ class SAM2AutomaticMaskGenerator:
         return cls(sam_model, **kwargs)
 
     @torch.no_grad()
-    def generate(self, image: np.ndarray) -> List[Dict[str, Any]]:
+    def generate(
+        self, image: np.ndarray, image_features: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
         """
-        Generates masks for the given image.
+        Generates masks for the given image. Afterwards, self.image_features
+        holds the predictor features of the full image, so a SAM2ImagePredictor
+        on the same model can reuse them for point prompts.
 
         Arguments:
           image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+          image_features (dict or None): Predictor features of the full image
+            computed before (SAM2ImagePredictor._features after set_image on
+            the same image). When given, the image encoder is skipped for the
+            uncropped layer.
 
         Returns:
            list(dict(str, any)): A list over records for masks. Each record is
@@ -193,7 +210,8 @@ class SAM2AutomaticMaskGenerator:
         """
 
         # Generate masks
-        mask_data = self._generate_masks(image)
+        self.image_features = None
+        mask_data = self._generate_masks(image, image_features)
 
         # Encode masks
         if self.output_mode == "coco_rle":
@@ -221,17 +239,21 @@ class SAM2AutomaticMaskGenerator:
 
         return curr_anns
 
-    def _generate_masks(self, image: np.ndarray) -> MaskData:
+    def _generate_masks(
+        self, image: np.ndarray, image_features: Optional[Dict[str, Any]] = None
+    ) -> MaskData:
         orig_size = image.shape[:2]
         crop_boxes, layer_idxs = generate_crop_boxes(
             orig_size, self.crop_n_layers, self.crop_overlap_ratio
         )
 
-        # Iterate over image crops
+        # Iterate over image crops, crops of the same layer share one encoder forward
         data = MaskData()
-        for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
-            data.cat(crop_data)
+        for crop_group in self._group_crops(crop_boxes, layer_idxs):
+            for crop_data in self._process_crops(
+                image, crop_group, orig_size, image_features
+            ):
+                data.cat(crop_data)
 
         # Remove duplicate masks between crops
         if len(crop_boxes) > 1:
@@ -248,6 +270,37 @@ class SAM2AutomaticMaskGenerator:
         data.to_numpy()
         return data
 
+    def _group_crops(
+        self, crop_boxes: List[List[int]], layer_idxs: List[int]
+    ) -> List[List[Tuple[List[int], int]]]:
+        """Splits the crops into batches of at most crop_batch_size crops from the same layer."""
+        groups = []
+        for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
+            if (
+                groups
+                and groups[-1][-1][1] == layer_idx
+                and len(groups[-1]) < self.crop_batch_size
+            ):
+                groups[-1].append((crop_box, layer_idx))
+            else:
+                groups.append([(crop_box, layer_idx)])
+        return groups
+
+    def _auto_points_per_batch(self, im_size: Tuple[int, ...]) -> int:
+        if self.points_per_batch is not None:
+            return self.points_per_batch
+        device = self.predictor.device
+        if device.type != "cuda":
+            return 64
+        free, _ = torch.cuda.mem_get_info(device)
+        h, w = im_size
+        n_masks = 3 if self.multimask_output else 1
+        # Per point: upscaled float logits and bool masks at crop resolution plus the
+        # 256x256 low res logits, doubled for the intermediates of the filtering steps
+        bytes_per_point = 2 * n_masks * (h * w * 5 + 256 * 256 * 4)
+        points_per_batch = int(free * 0.5) // bytes_per_point
+        return max(16, min(1024, points_per_batch // 16 * 16))
+
     def _process_crop(
         self,
         image: np.ndarray,
@@ -255,41 +308,74 @@ class SAM2AutomaticMaskGenerator:
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
     ) -> MaskData:
-        # Crop the image and calculate embeddings
-        x0, y0, x1, y1 = crop_box
-        cropped_im = image[y0:y1, x0:x1, :]
-        cropped_im_size = cropped_im.shape[:2]
-        self.predictor.set_image(cropped_im)
+        return self._process_crops(image, [(crop_box, crop_layer_idx)], orig_size)[0]
 
-        # Get points for this crop
-        points_scale = np.array(cropped_im_size)[None, ::-1]
-        points_for_image = self.point_grids[crop_layer_idx] * points_scale
+    def _process_crops(
+        self,
+        image: np.ndarray,
+        crops: List[Tuple[List[int], int]],
+        orig_size: Tuple[int, ...],
+        image_features: Optional[Dict[str, Any]] = None,
+    ) -> List[MaskData]:
+        # Crop the images and calculate embeddings in one batch; layer 0 is
+        # always a group of its own, the uncropped image
+        cropped_ims = [image[y0:y1, x0:x1, :] for (x0, y0, x1, y1), _ in crops]
+        full_image = crops[0][1] == 0
+        if full_image and image_features is not None:
+            self.predictor.reset_predictor()
+            self.predictor._features = image_features
+            self.predictor._orig_hw = [cropped_ims[0].shape[:2]]
+            self.predictor._is_image_set = True
+            self.predictor._is_batch = True
+        else:
+            self.predictor.set_image_batch(cropped_ims)
+        if full_image:
+            self.image_features = self.predictor._features
 
-        # Generate masks for this crop in batches
-        data = MaskData()
-        for (points,) in batch_iterator(self.points_per_batch, points_for_image):
-            batch_data = self._process_batch(
-                points, cropped_im_size, crop_box, orig_size, normalize=True
+        crop_datas = []
+        for img_idx, ((crop_box, crop_layer_idx), cropped_im) in enumerate(
+            zip(crops, cropped_ims)
+        ):
+            cropped_im_size = cropped_im.shape[:2]
+
+            # Get points for this crop
+            points_scale = np.array(cropped_im_size)[None, ::-1]
+            points_for_image = self.point_grids[crop_layer_idx] * points_scale
+
+            # Generate masks for this crop in batches
+            data = MaskData()
+            points_per_batch = self._auto_points_per_batch(cropped_im_size)
+            for (points,) in batch_iterator(points_per_batch, points_for_image):
+                batch_data = self._process_batch(
+                    points,
+                    cropped_im_size,
+                    crop_box,
+                    orig_size,
+                    normalize=True,
+                    img_idx=img_idx,
+                )
+                data.cat(batch_data)
+                del batch_data
+
+            # Remove duplicates within this crop.
+            keep_by_nms = batched_nms(
+                data["boxes"].float(),
+                data["iou_preds"],
+                torch.zeros_like(data["boxes"][:, 0]),  # categories
+                iou_threshold=self.box_nms_thresh,
             )
-            data.cat(batch_data)
-            del batch_data
-        self.predictor.reset_predictor()
+            data.filter(keep_by_nms)
 
-        # Remove duplicates within this crop.
-        keep_by_nms = batched_nms(
-            data["boxes"].float(),
-            data["iou_preds"],
-            torch.zeros_like(data["boxes"][:, 0]),  # categories
-            iou_threshold=self.box_nms_thresh,
-        )
-        data.filter(keep_by_nms)
+            # Return to the original image frame
+            data["boxes"] = uncrop_boxes_xyxy(data["boxes"], crop_box)
+            data["points"] = uncrop_points(data["points"], crop_box)
+            data["crop_boxes"] = torch.tensor(
+                [crop_box for _ in range(len(data["rles"]))]
+            )
+            crop_datas.append(data)
+        self.predictor.reset_predictor()
 
-        # Return to the original image frame
-        data["boxes"] = uncrop_boxes_xyxy(data["boxes"], crop_box)
-        data["points"] = uncrop_points(data["points"], crop_box)
-        data["crop_boxes"] = torch.tensor([crop_box for _ in range(len(data["rles"]))])
-
-        return data
+        return crop_datas
 
     def _process_batch(
         self,
@@ -298,6 +384,7 @@ class SAM2AutomaticMaskGenerator:
         crop_box: List[int],
         orig_size: Tuple[int, ...],
         normalize=False,
+        img_idx: int = -1,
     ) -> MaskData:
         orig_h, orig_w = orig_size
 
@@ -316,6 +403,7 @@ class SAM2AutomaticMaskGenerator:
             in_labels[:, None],
             multimask_output=self.multimask_output,
             return_logits=True,
+            img_idx=img_idx,
         )
 
         # Serialize predictions and store in MaskData
@@ -349,7 +437,11 @@ class SAM2AutomaticMaskGenerator:
                 in_points.shape[0], dtype=torch.int, device=in_points.device
             )
             masks, ious = self.refine_with_m2m(
-                in_points, labels, data["low_res_masks"], self.points_per_batch
+                in_points,
+                labels,
+                data["low_res_masks"],
+                len(points),
+                img_idx=img_idx,
             )
             data["masks"] = masks.squeeze(1)
             data["iou_preds"] = ious.squeeze(1)
@@ -393,48 +485,55 @@ class SAM2AutomaticMaskGenerator:
 
         Edits mask_data in place.
 
-        Requires open-cv as a dependency.
+        Uses the CUDA connected components kernel when it is available and
+        falls back to open-cv otherwise.
         """
         if len(mask_data["rles"]) == 0:
             return mask_data
 
-        # Filter small disconnected regions and holes
-        new_masks = []
-        scores = []
-        for rle in mask_data["rles"]:
-            mask = rle_to_mask(rle)
-
-            mask, changed = remove_small_regions(mask, min_area, mode="holes")
-            unchanged = not changed
-            mask, changed = remove_small_regions(mask, min_area, mode="islands")
-            unchanged = unchanged and not changed
-
-            new_masks.append(torch.as_tensor(mask).unsqueeze(0))
-            # Give score=0 to changed masks and score=1 to unchanged masks
-            # so NMS will prefer ones that didn't need postprocessing
-            scores.append(float(unchanged))
+        # Filter small disconnected regions and holes, on the GPU for all masks at once
+        # when the connected components kernel is available
+        masks = torch.as_tensor(np.stack([rle_to_mask(rle) for rle in mask_data["rles"]]))
+        if connected_components_available():
+            masks, changed = remove_small_regions_batched(masks, min_area)
+        else:
+            new_masks = []
+            changed = []
+            for mask in masks.numpy():
+                mask, changed_holes = remove_small_regions(mask, min_area, mode="holes")
+                mask, changed_islands = remove_small_regions(mask, min_area, mode="islands")
+                new_masks.append(torch.as_tensor(mask))
+                changed.append(changed_holes or changed_islands)
+            masks = torch.stack(new_masks, dim=0)
+            changed = torch.as_tensor(changed)
+
+        # Give score=0 to changed masks and score=1 to unchanged masks
+        # so NMS will prefer ones that didn't need postprocessing
+        scores = (~changed).float()
 
         # Recalculate boxes and remove any new duplicates
-        masks = torch.cat(new_masks, dim=0)
         boxes = batched_mask_to_box(masks)
         keep_by_nms = batched_nms(
             boxes.float(),
-            torch.as_tensor(scores),
+            scores,
             torch.zeros_like(boxes[:, 0]),  # categories
             iou_threshold=nms_thresh,
         )
 
-        # Only recalculate RLEs for masks that have changed
-        for i_mask in keep_by_nms:
-            if scores[i_mask] == 0.0:
-                mask_torch = masks[i_mask].unsqueeze(0)
-                mask_data["rles"][i_mask] = mask_to_rle_pytorch(mask_torch)[0]
+        # Only recalculate RLEs for masks that have changed, in one batched call
+        changed_idxs = keep_by_nms[changed[keep_by_nms]]
+        if len(changed_idxs) > 0:
+            new_rles = mask_to_rle_pytorch(masks[changed_idxs])
+            for i_mask, rle in zip(changed_idxs.tolist(), new_rles):
+                mask_data["rles"][i_mask] = rle
                 mask_data["boxes"][i_mask] = boxes[i_mask]  # update res directly
         mask_data.filter(keep_by_nms)
 
         return mask_data
 
-    def refine_with_m2m(self, points, point_labels, low_res_masks, points_per_batch):
+    def refine_with_m2m(
+        self, points, point_labels, low_res_masks, points_per_batch, img_idx=-1
+    ):
         new_masks = []
         new_iou_preds = []
 
@@ -447,6 +546,7 @@ class SAM2AutomaticMaskGenerator:
                 mask_input=low_res_mask[:, None, :],
                 multimask_output=False,
                 return_logits=True,
+                img_idx=img_idx,
             )
             new_masks.append(best_masks)
             new_iou_preds.append(best_iou_preds)
@@ -5,6 +5,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import logging
+import os
 
 import torch
 from hydra import compose
@@ -34,8 +35,9 @@ def build_sam2(
     cfg = compose(config_name=config_file, overrides=hydra_overrides_extra)
     OmegaConf.resolve(cfg)
     model = instantiate(cfg.model, _recursive_=True)
-    _load_checkpoint(model, ckpt_path)
+    # on the target device first, a converted checkpoint is then streamed straight into it
     model = model.to(device)
+    _load_checkpoint(model, ckpt_path)
     if mode == "eval":
         model.eval()
     return model
@@ -71,8 +73,9 @@ def build_sam2_video_predictor(
     cfg = compose(config_name=config_file, overrides=hydra_overrides)
     OmegaConf.resolve(cfg)
     model = instantiate(cfg.model, _recursive_=True)
-    _load_checkpoint(model, ckpt_path)
+    # on the target device first, a converted checkpoint is then streamed straight into it
     model = model.to(device)
+    _load_checkpoint(model, ckpt_path)
     if mode == "eval":
         model.eval()
     return model
@@ -116,10 +119,40 @@ def build_sam2_video_predictor_hf(model_id, **kwargs):
     )
 
 
+def _load_safetensors(model, path):
+    """Copy a memory-mapped safetensors checkpoint into the model one tensor at a time."""
+    from safetensors import safe_open
+
+    state = model.state_dict()
+    unexpected_keys = []
+    with safe_open(path, framework="pt", device="cpu") as f:
+        keys = list(f.keys())
+        with torch.no_grad():
+            for key in keys:
+                if key not in state:
+                    unexpected_keys.append(key)
+                    continue
+                tensor = f.get_tensor(key)
+                if tensor.shape != state[key].shape:
+                    raise RuntimeError(
+                        f"size mismatch for {key}: shape {tuple(tensor.shape)} in checkpoint, "
+                        f"{tuple(state[key].shape)} in model"
+                    )
+                state[key].copy_(tensor)
+    found = set(keys)
+    missing_keys = [key for key in state if key not in found]
+    return missing_keys, unexpected_keys
+
+
 def _load_checkpoint(model, ckpt_path):
     if ckpt_path is not None:
-        sd = torch.load(ckpt_path, map_location="cpu")["model"]
-        missing_keys, unexpected_keys = model.load_state_dict(sd)
+        # prefer the output of models/convert_to_safetensors.py next to the checkpoint
+        fast_path = os.path.splitext(ckpt_path)[0] + ".safetensors"
+        if os.path.exists(fast_path):
+            missing_keys, unexpected_keys = _load_safetensors(model, fast_path)
+        else:
+            sd = torch.load(ckpt_path, map_location="cpu")["model"]
+            missing_keys, unexpected_keys = model.load_state_dict(sd)
         if missing_keys:
             logging.error(missing_keys)
             raise RuntimeError()
@@ -4,8 +4,10 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import importlib.util
 import math
 from copy import deepcopy
+from functools import lru_cache
 from itertools import product
 from typing import Any, Dict, Generator, ItemsView, List, Tuple
 
@@ -113,26 +115,43 @@ def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
     """
     # Put in fortran order and flatten h,w
     b, h, w = tensor.shape
+    if b == 0:
+        return []
     tensor = tensor.permute(0, 2, 1).flatten(1)
 
-    # Compute change indices
+    # Compute change indices, nonzero() returns them sorted by mask then position
     diff = tensor[:, 1:] ^ tensor[:, :-1]
     change_indices = diff.nonzero()
-
-    # Encode run length
+    mask_idxs, change_pos = change_indices[:, 0], change_indices[:, 1]
+
+    # Lay out the run boundaries of every mask back to back as [0, changes + 1, h * w]
+    # and take a single diff over the whole batch
+    n_changes = torch.bincount(mask_idxs, minlength=b)
+    n_bounds = n_changes + 2
+    bound_starts = torch.cumsum(n_bounds, dim=0) - n_bounds
+    change_starts = torch.cumsum(n_changes, dim=0) - n_changes
+    rank_in_mask = torch.arange(len(change_pos), device=tensor.device) - change_starts[mask_idxs]
+
+    bounds = torch.empty(int(n_bounds.sum()), dtype=change_pos.dtype, device=tensor.device)
+    bounds[bound_starts] = 0
+    bounds[bound_starts + n_bounds - 1] = h * w
+    bounds[bound_starts[mask_idxs] + 1 + rank_in_mask] = change_pos + 1
+
+    # Drop the diffs that straddle two masks
+    keep = torch.ones(len(bounds) - 1, dtype=torch.bool, device=tensor.device)
+    keep[(bound_starts + n_bounds - 1)[:-1]] = False
+    btw_idxs = (bounds[1:] - bounds[:-1])[keep]
+
+    # Encode run length, one host transfer for the whole batch
+    btw_idxs = btw_idxs.detach().cpu().tolist()
+    n_runs = (n_changes + 1).detach().cpu().tolist()
+    starts_on = (tensor[:, 0] != 0).detach().cpu().tolist()
     out = []
+    start = 0
     for i in range(b):
-        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
-        cur_idxs = torch.cat(
-            [
-                torch.tensor([0], dtype=cur_idxs.dtype, device=cur_idxs.device),
-                cur_idxs + 1,
-                torch.tensor([h * w], dtype=cur_idxs.dtype, device=cur_idxs.device),
-            ]
-        )
-        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
-        counts = [] if tensor[i, 0] == 0 else [0]
-        counts.extend(btw_idxs.detach().cpu().tolist())
+        counts = [0] if starts_on[i] else []
+        counts.extend(btw_idxs[start : start + n_runs[i]])
+        start += n_runs[i]
         out.append({"size": [h, w], "counts": counts})
     return out
 
@@ -140,13 +159,10 @@ def mask_to_rle_pytorch(tensor: torch.Tensor) -> List[Dict[str, Any]]:
 def rle_to_mask(rle: Dict[str, Any]) -> np.ndarray:
     """Compute a binary mask from an uncompressed RLE."""
     h, w = rle["size"]
-    mask = np.empty(h * w, dtype=bool)
-    idx = 0
-    parity = False
-    for count in rle["counts"]:
-        mask[idx : idx + count] = parity
-        idx += count
-        parity ^= True
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    # runs alternate between background and foreground, starting with background
+    parity = np.arange(len(counts)) % 2 == 1
+    mask = np.repeat(parity, counts)
     mask = mask.reshape(w, h)
     return mask.transpose()  # Put in C order
 
@@ -293,6 +309,54 @@ def remove_small_regions(
     return mask, True
 
 
+@lru_cache(maxsize=None)
+def connected_components_available() -> bool:
+    """Whether remove_small_regions_batched can run: CUDA and the sam2._C extension."""
+    return torch.cuda.is_available() and importlib.util.find_spec("sam2._C") is not None
+
+
+def remove_small_regions_batched(
+    masks: torch.Tensor, area_thresh: float, chunk_size: int = 64
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Batched version of remove_small_regions for a BxHxW bool tensor: fills
+    holes and then removes islands smaller than area_thresh. Returns the
+    masks and a length B bool tensor of which masks have been modified.
+
+    Requires the CUDA connected components kernel (sam2._C), so masks are
+    processed on the GPU in chunks of chunk_size.
+    """
+    from sam2.utils.misc import get_connected_components
+
+    out_masks, out_changed = [], []
+    for (chunk,) in batch_iterator(chunk_size, masks):
+        chunk = chunk.to("cuda")[:, None]
+
+        # Holes: small components of the background
+        labels, areas = get_connected_components(~chunk)
+        holes = (labels > 0) & (areas < area_thresh)
+        chunk = chunk | holes
+
+        # Islands: small components of the foreground, but keep the largest one
+        # if every region is below the threshold
+        labels, areas = get_connected_components(chunk)
+        islands = (labels > 0) & (areas < area_thresh)
+        all_small = (islands == chunk).flatten(1).all(dim=1) & chunk.flatten(1).any(dim=1)
+        # exactly one largest component, the first in raster order like np.argmax over the
+        # OpenCV labels, even when several share the largest area
+        first_largest = areas.flatten(1).argmax(dim=1, keepdim=True)
+        largest = labels == labels.flatten(1).gather(1, first_largest)[:, :, None, None]
+        islands = torch.where(all_small[:, None, None, None], chunk & ~largest, islands)
+        chunk = chunk & ~islands
+
+        # a mask whose regions are all small counts as changed even when it keeps its only one
+        out_masks.append(chunk[:, 0].to(masks.device))
+        out_changed.append(
+            (holes.flatten(1).any(dim=1) | islands.flatten(1).any(dim=1) | all_small).to(masks.device)
+        )
+    return torch.cat(out_masks), torch.cat(out_changed)
+
+
 def coco_encode_rle(uncompressed_rle: Dict[str, Any]) -> Dict[str, Any]:
     from pycocotools import mask as mask_utils  # type: ignore
 
@@ -0,0 +1,71 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
+from sam2.build_sam import build_sam2
+
+
+def run(mask_generator, image, repeats):
+    device = mask_generator.predictor.device
+    # warm up kernels and the allocator before timing
+    mask_generator.generate(image)
+    times = []
+    for _ in range(repeats):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        anns = mask_generator.generate(image)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return anns, float(np.median(times))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare sequential and batched crop processing in SAM2AutomaticMaskGenerator"
+    )
+    parser.add_argument("--sam2_cfg", type=str, default="sam2_hiera_l.yaml")
+    parser.add_argument(
+        "--sam2_checkpoint", type=str, default="./checkpoints/sam2_hiera_large.pt"
+    )
+    parser.add_argument("--image", type=str, default="./images/cars.jpg")
+    parser.add_argument("--crop_n_layers", type=int, default=1)
+    parser.add_argument("--points_per_side", type=int, default=32)
+    parser.add_argument("--crop_batch_size", type=int, default=4)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = build_sam2(args.sam2_cfg, args.sam2_checkpoint, device=device)
+    image = np.array(Image.open(args.image).convert("RGB"))
+
+    common = dict(
+        points_per_side=args.points_per_side,
+        crop_n_layers=args.crop_n_layers,
+        output_mode="uncompressed_rle",
+    )
+    # crop_batch_size=1 with a fixed points_per_batch is the previous sequential behaviour
+    sequential = SAM2AutomaticMaskGenerator(
+        model, points_per_batch=64, crop_batch_size=1, **common
+    )
+    batched = SAM2AutomaticMaskGenerator(
+        model, points_per_batch=None, crop_batch_size=args.crop_batch_size, **common
+    )
+
+    seq_anns, seq_time = run(sequential, image, args.repeats)
+    bat_anns, bat_time = run(batched, image, args.repeats)
+
+    print(f"image {args.image} {image.shape[1]}x{image.shape[0]}, crop_n_layers={args.crop_n_layers}")
+    print(f"sequential: {seq_time:7.2f} s, {len(seq_anns)} masks")
+    print(
+        f"batched:    {bat_time:7.2f} s, {len(bat_anns)} masks "
+        f"(crop_batch_size={args.crop_batch_size}, {seq_time / bat_time:.2f}x)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+from sam2.utils.amg import mask_to_rle_pytorch, rle_to_mask
+
+
+def mask_to_rle_pytorch_loop(tensor):
+    """Per-mask RLE encoding, as shipped before the batched version."""
+    b, h, w = tensor.shape
+    tensor = tensor.permute(0, 2, 1).flatten(1)
+    diff = tensor[:, 1:] ^ tensor[:, :-1]
+    change_indices = diff.nonzero()
+    out = []
+    for i in range(b):
+        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
+        cur_idxs = torch.cat(
+            [
+                torch.tensor([0], dtype=cur_idxs.dtype, device=cur_idxs.device),
+                cur_idxs + 1,
+                torch.tensor([h * w], dtype=cur_idxs.dtype, device=cur_idxs.device),
+            ]
+        )
+        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
+        counts = [] if tensor[i, 0] == 0 else [0]
+        counts.extend(btw_idxs.detach().cpu().tolist())
+        out.append({"size": [h, w], "counts": counts})
+    return out
+
+
+def rle_to_mask_loop(rle):
+    """Python-loop RLE decoding, as shipped before the np.repeat version."""
+    h, w = rle["size"]
+    mask = np.empty(h * w, dtype=bool)
+    idx = 0
+    parity = False
+    for count in rle["counts"]:
+        mask[idx : idx + count] = parity
+        idx += count
+        parity ^= True
+    mask = mask.reshape(w, h)
+    return mask.transpose()
+
+
+def random_masks(num_masks, size, device, seed=0):
+    """Random ellipses (plus a few full and empty masks) that look like AMG output."""
+    generator = torch.Generator().manual_seed(seed)
+    ys = torch.arange(size, dtype=torch.float32)[None, :, None]
+    xs = torch.arange(size, dtype=torch.float32)[None, None, :]
+    centers = torch.rand(num_masks, 2, generator=generator) * size
+    radii = torch.rand(num_masks, 2, generator=generator) * size / 4 + 4
+    cy, cx = centers[:, 0, None, None], centers[:, 1, None, None]
+    ry, rx = radii[:, 0, None, None], radii[:, 1, None, None]
+    # build in chunks, the float distance maps for 1000 masks at 1024x1024 would need 4 GB
+    masks = torch.cat(
+        [
+            ((ys - cy[i : i + 50]) / ry[i : i + 50]) ** 2 + ((xs - cx[i : i + 50]) / rx[i : i + 50]) ** 2 <= 1
+            for i in range(0, num_masks, 50)
+        ]
+    )
+    masks[0] = True
+    masks[-1] = False
+    return masks.to(device)
+
+
+def timed(fn, *args, device=None):
+    sync = device is not None and device.type == "cuda"
+    if sync:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    out = fn(*args)
+    if sync:
+        torch.cuda.synchronize()
+    return out, time.perf_counter() - start
+
+
+def main(args):
+    device = torch.device(args.device)
+    for num_masks in args.num_masks:
+        masks = random_masks(num_masks, args.size, device)
+
+        loop_rles, loop_enc = timed(mask_to_rle_pytorch_loop, masks, device=device)
+        rles, enc = timed(mask_to_rle_pytorch, masks, device=device)
+        assert rles == loop_rles, "batched RLE encoding does not match the per-mask encoding"
+
+        loop_dec_masks, loop_dec = timed(lambda r: [rle_to_mask_loop(x) for x in r], rles)
+        dec_masks, dec = timed(lambda r: [rle_to_mask(x) for x in r], rles)
+        assert all(np.array_equal(a, b) for a, b in zip(dec_masks, loop_dec_masks))
+        assert np.array_equal(np.stack(dec_masks), masks.cpu().numpy())
+
+        print(
+            f"{num_masks:5d} masks @ {args.size}x{args.size} on {device}: "
+            f"encode {loop_enc * 1000:8.1f} ms -> {enc * 1000:8.1f} ms ({loop_enc / enc:5.1f}x), "
+            f"decode {loop_dec * 1000:8.1f} ms -> {dec * 1000:8.1f} ms ({loop_dec / dec:5.1f}x)"
+        )
+        del masks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-mask and batched RLE encode/decode in sam2.utils.amg")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--size", type=int, default=1024, help="mask height and width")
+    parser.add_argument("--num_masks", type=int, nargs="+", default=[100, 300, 1000])
+    main(parser.parse_args())
@@ -62,45 +62,125 @@ def load_image_from_base64(base64_str: str) -> Image.Image:
     image = Image.open(BytesIO(image_bytes)).convert("RGB")
     return image
 
-endpoint_url, key = load_runpod_info()
-db_client = load_db_connection()
+def rle_to_mask_array(rle: dict) -> np.ndarray:
+    # uncompressed COCO RLE: alternating background/foreground run lengths over the column-major mask
+    h, w = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    values = np.arange(len(counts)) % 2 == 1
+    return np.repeat(values, counts).reshape(w, h).T
 
-def SAM2(image: Image, points: np.array, labels: np.array, rgba: tuple):
-    image_b64 = image_to_base64(image)
+def rle_to_mask_image(rle: dict) -> Image.Image:
+    return Image.fromarray(rle_to_mask_array(rle).astype(np.uint8) * 255, "L")
 
-    points = points.tolist()
-    labels = labels.tolist()
-
-    url = endpoint_url
+endpoint_url, key = load_runpod_info()
+db_client = load_db_connection()
 
+def post_sam2(job_input: dict) -> dict:
     headers = {
         'Authorization': f'Bearer {key}',
         'Content-Type': 'application/json'
     }
 
-    input_dict = {
-        "input": {
-            "image": image_b64,
-            "points": points,
-            "labels": labels,
-            "R": 50,
-            "G": 50,
-            "B": 50,
-            "A": 255
-        }
-    }
-
-    payload = json.dumps(input_dict)
+    payload = json.dumps({"input": job_input})
 
     response = requests.post(
-        url = url,
+        url = endpoint_url,
         headers = headers,
         data = payload
     )
 
-    mask_b64 = json.loads(response.text)["output"]["mask"]
-
-    return load_image_from_base64(mask_b64)
+    return json.loads(response.text)["output"]
+
+def SAM2(image: Image, points: np.array, labels: np.array, rgba: tuple, image_id: str = None, mask_input: str = None):
+    job_input = {
+        "points": points.tolist(),
+        "labels": labels.tolist(),
+        "R": 50,
+        "G": 50,
+        "B": 50,
+        "A": 255,
+        "mask_format": "rle"
+    }
+    if mask_input is not None:
+        job_input["mask_input"] = mask_input
+
+    output = None
+    if image_id is not None:
+        # the worker keeps the image embedding, so only the points need to travel
+        output = post_sam2({**job_input, "image_id": image_id})
+        if output.get("cache_miss"):
+            output = None
+
+    if output is None:
+        output = post_sam2({**job_input, "image": image_to_base64(image)})
+
+    return rle_to_mask_image(output["mask"]), output.get("image_id"), output.get("logits")
+
+def SAM2_batch(images: list, points: list, labels: list, image_ids: list):
+    # one request (and one backbone forward on the worker) for several images, one prompt set each
+    items = []
+    for image, image_points, image_labels, image_id in zip(images, points, labels, image_ids):
+        item = {"prompts": [{"points": image_points.tolist(), "labels": image_labels.tolist()}]}
+        if image_id is not None:
+            item["image_id"] = image_id
+        else:
+            item["image"] = image_to_base64(image)
+        items.append(item)
+
+    job_input = {"images": items, "R": 50, "G": 50, "B": 50, "A": 255, "mask_format": "rle"}
+    output = post_sam2(job_input)
+
+    if output.get("cache_miss"):
+        # the retry may land on another worker where the other ids miss as well, so send every image
+        for item, image in zip(items, images):
+            item.pop("image_id", None)
+            item["image"] = image_to_base64(image)
+        output = post_sam2(job_input)
+
+    if "results" not in output:
+        raise RuntimeError(f"SAM2 batch request failed: {output}")
+
+    return [
+        (rle_to_mask_image(result["masks"][0]), result["image_id"], result["logits"][0])
+        for result in output["results"]
+    ]
+
+def SAM2_everything(image: Image):
+    output = post_sam2({"image": image_to_base64(image), "mode": "everything"})
+
+    h, w = output["size"]
+    masks = [rle_to_mask_array(rle) for rle in output["masks"]]
+    masks = np.stack(masks) if masks else np.zeros((0, h, w), dtype=bool)
+
+    return {"image_id": output["image_id"], "masks": masks, "bboxes": output["bboxes"]}
+
+def resolve_click(everything, points, labels):
+    # union of the smallest precomputed mask under each green point that avoids every red point,
+    # None when some green point is not covered so the caller can fall back to SAM2
+    masks, bboxes = everything["masks"], everything["bboxes"]
+    h, w = masks.shape[1:]
+    points = [(min(max(x, 0), w - 1), min(max(y, 0), h - 1)) for x, y in points]
+    negatives = [point for point, label in zip(points, labels) if label == 0]
+
+    result = np.zeros((h, w), dtype=bool)
+    for (x, y), label in zip(points, labels):
+        if label != 1:
+            continue
+
+        hit = None
+        for i, (bx, by, bw, bh) in enumerate(bboxes):
+            if not (bx <= x <= bx + bw and by <= y <= by + bh) or not masks[i, y, x]:
+                continue
+            if any(masks[i, ny, nx] for nx, ny in negatives):
+                continue
+            hit = i
+            break
+
+        if hit is None:
+            return None
+        result |= masks[hit]
+
+    return result if result.any() else None
 
 def overlay(image, mask, borders=True):
     image_np = np.array(image)
@@ -176,6 +256,12 @@ def process_image(prefix):
             st.session_state[f"{prefix}_green_points"] = current_green_points
             st.session_state[f"{prefix}_red_points"] = current_red_points
 
+        if st.checkbox("Precompute all masks for instant clicks", key=f"{prefix}_precompute"):
+            if f"{prefix}_everything" not in st.session_state:
+                sam2_input_image = st.session_state[f"{prefix}_original_image"].resize((512, 512))
+                with st.spinner(f"Precomputing masks for {prefix} image"):
+                    st.session_state[f"{prefix}_everything"] = SAM2_everything(sam2_input_image)
+
         if st.button(f"Create Mask for {prefix.capitalize()} Image"):
             create_mask(prefix)
 
@@ -185,11 +271,10 @@ def process_image(prefix):
             
             st.session_state[f"{prefix}_mask_created"] = True
 
-def create_mask(prefix):
+def sam2_inputs(prefix):
     original_image = st.session_state[f"{prefix}_original_image"]
     resized_image = st.session_state[f"{prefix}_image"]
     
-    original_size = original_image.size
     new_size = (512, 512)  
     display_size = resized_image.size  
 
@@ -201,10 +286,57 @@ def create_mask(prefix):
 
     sam2_input_image = original_image.resize(new_size)
 
+    return sam2_input_image, sam_points, sam_labels, display_size
+
+def refinement_logits(prefix, sam_points, sam_labels):
+    # previous low-res logits only help when the user kept the old clicks and added new ones
+    previous_prompts = st.session_state.get(f"{prefix}_mask_prompts")
+    if previous_prompts is None or not previous_prompts <= set(zip(sam_points, sam_labels)):
+        return None
+    return st.session_state.get(f"{prefix}_mask_logits")
+
+def store_mask(prefix, mask, image_id, logits, sam_points, sam_labels, display_size):
+    st.session_state[f"{prefix}_image_id"] = image_id
+    st.session_state[f"{prefix}_mask_logits"] = logits
+    st.session_state[f"{prefix}_mask_prompts"] = set(zip(sam_points, sam_labels))
+    st.session_state[f"{prefix}_mask"] = mask.resize(display_size)
+
+def create_mask(prefix):
+    sam2_input_image, sam_points, sam_labels, display_size = sam2_inputs(prefix)
+
+    everything = st.session_state.get(f"{prefix}_everything") if st.session_state.get(f"{prefix}_precompute") else None
+    if everything is not None:
+        local_mask = resolve_click(everything, sam_points, sam_labels)
+        if local_mask is not None:
+            mask = Image.fromarray(local_mask.astype(np.uint8) * 255, "L")
+            store_mask(prefix, mask, st.session_state.get(f"{prefix}_image_id"), None, sam_points, sam_labels, display_size)
+            return
+
     with st.spinner(f"Generating mask for {prefix} image"):
-        mask = SAM2(image=sam2_input_image, points=np.array(sam_points), labels=np.array(sam_labels), rgba=(50, 50, 50, 255))
+        mask, image_id, logits = SAM2(
+            image=sam2_input_image,
+            points=np.array(sam_points),
+            labels=np.array(sam_labels),
+            rgba=(50, 50, 50, 255),
+            image_id=st.session_state.get(f"{prefix}_image_id"),
+            mask_input=refinement_logits(prefix, sam_points, sam_labels)
+        )
     
-    st.session_state[f"{prefix}_mask"] = mask.resize(display_size)
+    store_mask(prefix, mask, image_id, logits, sam_points, sam_labels, display_size)
+
+def create_masks(prefixes):
+    inputs = [sam2_inputs(prefix) for prefix in prefixes]
+
+    with st.spinner("Generating masks for all images"):
+        results = SAM2_batch(
+            images=[sam2_input_image for sam2_input_image, _, _, _ in inputs],
+            points=[np.array(sam_points) for _, sam_points, _, _ in inputs],
+            labels=[np.array(sam_labels) for _, _, sam_labels, _ in inputs],
+            image_ids=[st.session_state.get(f"{prefix}_image_id") for prefix in prefixes]
+        )
+
+    for prefix, (_, sam_points, sam_labels, display_size), (mask, image_id, logits) in zip(prefixes, inputs, results):
+        store_mask(prefix, mask, image_id, logits, sam_points, sam_labels, display_size)
 
 def submit_mask_data(base_url, reference_url, email):
     backend_url = os.getenv("BACKEND_URL")
@@ -471,6 +603,11 @@ def main():
         with col1:
             st.subheader("Base Image")
             process_image("base")
+
+        if st.session_state.get("base_green_points") and st.session_state.get("reference_green_points"):
+            if st.button("Create Masks for Both Images"):
+                create_masks(["base", "reference"])
+                st.rerun()
       
 
     elif page == "Draw":